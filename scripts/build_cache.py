@@ -0,0 +1,171 @@
+#! /usr/bin/env python
+
+#
+# Copyright (c) 2015 Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+from __future__ import print_function
+import os
+import hashlib
+import struct
+from tftf import Tftf
+from util import error, update_digest, read_chunks, clone_file, \
+    evict_lru_files, map_in_order
+
+# Default upper bound on the size of the cache directory
+DEFAULT_BUILD_CACHE_SIZE = 256 * 1024 * 1024
+
+BUILD_CACHE_FILE_EXTENSION = ".tftf"
+
+# Version of the build key, to be bumped whenever create-tftf's output
+# changes for the same inputs
+BUILD_CACHE_KEY_VERSION = "create-tftf 2"
+
+# Size of the chunks in which section files are hashed
+BUILD_CACHE_READ_SIZE = 64 * 1024
+
+
+def get_contents_digest(section):
+    # Return the digest of the contents of a section's file, or only of
+    # the span of it making up the section if it has a length (e.g., an
+    # ELF segment, so that the ELF's debug info isn't hashed)
+    contents_hash = hashlib.sha256()
+    with open(section['file'], 'rb') as rf:
+        if 'length' in section:
+            rf.seek(section['skip'])
+            remaining = section['length']
+            while remaining > 0:
+                chunk = rf.read(min(remaining, BUILD_CACHE_READ_SIZE))
+                if not chunk:
+                    raise IOError("{0:s} is truncated".format(
+                                  section['file']))
+                contents_hash.update(chunk)
+                remaining -= len(chunk)
+        else:
+            update_digest(contents_hash,
+                          read_chunks(rf, BUILD_CACHE_READ_SIZE))
+    return contents_hash.digest()
+
+
+def get_build_key(header_fields, sections, num_jobs=1):
+    """Return the build cache key for a TFTF
+
+    The key is a digest of the header fields (a sequence of the values
+    which go into the TFTF header, with the timestamp only if it has been
+    pinned for a reproducible build), and of each section (as staged by
+    create-tftf): its type, offset, skip, address, lengths and the
+    contents of its file (or of its span of the file).  The sections'
+    contents are hashed num_jobs at a time.
+    Raises IOError if a section file can't be read.
+    """
+    key_hash = hashlib.sha256(BUILD_CACHE_KEY_VERSION)
+    key_hash.update(repr(tuple(header_fields)))
+    contents_digests = map_in_order(get_contents_digest, sections,
+                                    num_jobs, threads=True)
+    for section, contents_digest in zip(sections, contents_digests):
+        key_hash.update(repr((section['type'], section.get('offset', 0),
+                              section.get('skip', 0), section.get('addr'),
+                              section.get('length'),
+                              section.get('expanded_length'))))
+        key_hash.update(contents_digest)
+    return key_hash.hexdigest()
+
+
+class BuildCache:
+    """On-disk cache of TFTF files built by create-tftf
+
+    TFTFs are cached by their build key (see: get_build_key), so that a
+    TFTF whose inputs haven't changed can be produced without building
+    it again.  Each TFTF is stored in its own file in the cache directory,
+    and is cloned (reflinked, or else copied) to the output file on a hit.
+    (Never hard-linked, as the output file may later be rewritten in
+    place.)  The cache is held under max_size bytes by evicting the
+    least-recently-used entries (each hit refreshes the entry's mtime).
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_BUILD_CACHE_SIZE):
+        """Constructor"""
+        self.directory = directory
+        self.max_size = max_size
+
+    def entry_filename(self, key):
+        # Return the name of the cache file for a build key
+        return os.path.join(self.directory,
+                            key + BUILD_CACHE_FILE_EXTENSION)
+
+    def check_entry(self, entry_filename):
+        # Return a flag indicating if a cache entry is a whole TFTF, i.e.,
+        # a valid header followed by all of its sections' data
+        try:
+            tftf = Tftf(entry_filename, use_mmap=True)
+        except struct.error:
+            return False
+        return tftf.is_good() and \
+            tftf.tftf_length == tftf.get_streamed_length()
+
+    def get(self, key, filename):
+        """Produce a cached TFTF
+
+        Replaces filename with a clone of the TFTF cached under the key.
+        Returns True on a hit, False on a cache miss (or an unusable
+        entry, which is then rebuilt).
+        """
+        entry_filename = self.entry_filename(key)
+        if not os.path.isfile(entry_filename):
+            return False
+        if not self.check_entry(entry_filename):
+            error("Ignoring the corrupt cache entry", entry_filename)
+            return False
+        try:
+            clone_file(entry_filename, filename, allow_link=False)
+            os.utime(entry_filename, None)
+        except (IOError, OSError) as e:
+            error("Unable to use the cache entry", entry_filename, "-", e)
+            return False
+        return True
+
+    def put(self, key, filename):
+        """Add a TFTF file to the cache and return a success flag
+
+        The entry is a reflink or copy (never a hard link) of the file,
+        so that the file can be rewritten without changing the cache.
+        """
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            clone_file(filename, self.entry_filename(key), allow_link=False)
+        except (IOError, OSError) as e:
+            error("Unable to cache", filename, "in", self.directory, "-", e)
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        # Evict the least-recently-used entries until the cache fits
+        # within its size limit
+        evict_lru_files(self.directory, BUILD_CACHE_FILE_EXTENSION,
+                        self.max_size)
@@ -29,8 +29,6 @@
 #
 
 from __future__ import print_function
-from time import gmtime, strftime
-from struct import unpack_from, pack_into
 from ffff_element import FFFF_HDR_LENGTH, FFFF_HDR_VALID, \
     FFFF_MAX_HEADER_BLOCK_SIZE, FFFF_HDR_OFF_TAIL_SENTINEL, \
     FFFF_HDR_OFF_ELEMENT_TBL, FFFF_MAX_ELEMENTS, FfffElement, \
@@ -38,11 +36,16 @@ from ffff_element import FFFF_HDR_LENGTH, FFFF_HDR_VALID, \
     FFFF_HDR_OFF_FLASH_CAPACITY, FFFF_FLASH_IMAGE_NAME_LENGTH, \
     FFFF_ELEMENT_END_OF_ELEMENT_TABLE, FFFF_HEADER_COLLISION, \
     FFFF_HDR_ERASED, FFFF_SENTINEL, \
-    FFFF_HDR_INVALID
+    FFFF_HDR_INVALID, ffff_validity_names
 import sys
+from collections import OrderedDict
 
+from profiling import timed
+from layout import FFFF_HEADER, FFFF_HEADER_ID, FFFF_HEADER_NAME, \
+    FFFF_HEADER_FIELDS, FFFF_TAIL_SENTINEL, FFFF_ELEMENT_TABLE
 from util import error, is_power_of_2, next_boundary, is_constant_fill, \
-    PROGRAM_SUCCESS, PROGRAM_WARNINGS, PROGRAM_ERRORS
+    find_overlaps, find_duplicates, PROGRAM_SUCCESS, PROGRAM_WARNINGS, \
+    PROGRAM_ERRORS, c_string, get_timestamp
 
 def header_block_size(erase_block_size):
     # Determine the size of the FFFF header block
@@ -68,8 +71,13 @@ class Ffff:
     """
 
     def __init__(self, buf, offset, flash_image_name, flash_capacity,
-                 erase_block_size, image_length, header_generation_number):
-        """FFFF constructor"""
+                 erase_block_size, image_length, header_generation_number,
+                 sparse=False):
+        """FFFF constructor
+
+        If sparse is set, buf only covers the header blocks, and the
+        elements' TFTFs are not placed in it (see: FfffRomimage.init).
+        """
         # FFFF header fields
         self.sentinel = ""
         self.timestamp = ""
@@ -85,6 +93,7 @@ class Ffff:
 
         # Private vars
         self.ffff_buf = buf
+        self.sparse = sparse
         self.header_offset = offset
         self.collisions = []
         self.collisions_found = False
@@ -98,11 +107,15 @@ class Ffff:
     def header_block_size(self):
         return header_block_size(self.erase_block_size)
 
-    def unpack(self):
-        """Unpack an FFFF header from a buffer"""
+    @timed("ffff.unpack")
+    def unpack(self, tftf_cache=None):
+        """Unpack an FFFF header from a buffer
+
+        The elements' TFTFs are parsed lazily (see: FfffElement.tftf_blob),
+        sharing parsed TFTFs through the tftf_cache dictionary if supplied.
+        """
 
-        ffff_hdr = unpack_from("<16s16s48sLLLLL", self.ffff_buf,
-                               self.header_offset)
+        ffff_hdr = FFFF_HEADER.unpack_from(self.ffff_buf, self.header_offset)
         self.sentinel = ffff_hdr[0]
         self.timestamp = ffff_hdr[1]
         self.flash_image_name = ffff_hdr[2]
@@ -113,32 +126,33 @@ class Ffff:
         self.header_generation_number = ffff_hdr[7]
 
         # unpack the tail sentinel
-        ffff_hdr = unpack_from("<16s", self.ffff_buf,
-                               self.header_offset + FFFF_HDR_OFF_TAIL_SENTINEL)
+        ffff_hdr = FFFF_TAIL_SENTINEL.unpack_from(
+            self.ffff_buf, self.header_offset + FFFF_HDR_OFF_TAIL_SENTINEL)
         self.tail_sentinel = ffff_hdr[0]
 
         # Determine the ROM range that can hold the elements
         self.element_location_min = 2 * self.header_block_size()
         self.element_location_max = self.flash_capacity
 
-        # Parse the table of element headers
+        # Parse the table of element headers (decoded in one go)
         self.elements = []
-        offset = FFFF_HDR_OFF_ELEMENT_TBL
-        for index in range(FFFF_MAX_ELEMENTS):
+        element_table = FFFF_ELEMENT_TABLE.iter_unpack(
+            self.ffff_buf, self.header_offset + FFFF_HDR_OFF_ELEMENT_TBL)
+        for index, element_hdr in enumerate(element_table):
             element = FfffElement(index,
                                   self.ffff_buf,
                                   self.flash_capacity,
                                   self.erase_block_size,
                                   0, 0, 0, 0, 0)
-            if not element.unpack(self.ffff_buf, offset):
+            element.tftf_cache = tftf_cache
+            if not element.unpack_descriptor(self.ffff_buf, element_hdr):
                 self.elements.append(element)
-                offset += FFFF_ELT_LENGTH
             else:
                 # Stop on the first unused element
-                print("unpack done")
                 break
         self.validate_ffff_header()
 
+    @timed("ffff.pack")
     def pack(self):
         # Pack the FFFF header members into a FFFF header buffer, prior
         # to writing the buffer out to a file.
@@ -146,23 +160,26 @@ class Ffff:
         # Populate the fixed part of the FFFF header.
         # (Note that we need to break up the packing because the "s" format
         # won't zero-pad a string shorter than the field width)
-        timestamp = strftime("%Y%m%d %H%M%S", gmtime())
-        pack_into("<16s16s", self.ffff_buf, self.header_offset,
-                  self.sentinel, timestamp)
+        FFFF_HEADER_ID.pack_into(self.ffff_buf, self.header_offset,
+                                 self.sentinel,
+                                 self.timestamp or get_timestamp())
         if self.flash_image_name:
-            pack_into("<48s", self.ffff_buf,
-                      self.header_offset + FFFF_HDR_OFF_FLASH_IMAGE_NAME,
-                      self.flash_image_name)
-        pack_into("<LLLLL", self.ffff_buf,
-                  self.header_offset + FFFF_HDR_OFF_FLASH_CAPACITY,
-                  self.flash_capacity,
-                  self.erase_block_size,
-                  FFFF_HDR_LENGTH,
-                  self.flash_image_length,
-                  self.header_generation_number)
-        pack_into("<16s", self.ffff_buf,
-                  self.header_offset + FFFF_HDR_OFF_TAIL_SENTINEL,
-                  self.tail_sentinel)
+            FFFF_HEADER_NAME.pack_into(
+                self.ffff_buf,
+                self.header_offset + FFFF_HDR_OFF_FLASH_IMAGE_NAME,
+                self.flash_image_name)
+        FFFF_HEADER_FIELDS.pack_into(
+            self.ffff_buf,
+            self.header_offset + FFFF_HDR_OFF_FLASH_CAPACITY,
+            self.flash_capacity,
+            self.erase_block_size,
+            FFFF_HDR_LENGTH,
+            self.flash_image_length,
+            self.header_generation_number)
+        FFFF_TAIL_SENTINEL.pack_into(
+            self.ffff_buf,
+            self.header_offset + FFFF_HDR_OFF_TAIL_SENTINEL,
+            self.tail_sentinel)
 
         # Pack the element headers into the FFFF header buffer
         offset = self.header_offset + FFFF_HDR_OFF_ELEMENT_TBL
@@ -191,15 +208,21 @@ class Ffff:
                                   element_location,
                                   element_length,
                                   filename)
-            if element.init():
-                self.elements.append(element)
+            return element.init() and self.append_element(element)
+        else:
+            error("too many elements")
+            return False
 
-                span_start = element.element_location
-                span_end = span_start + len(element.tftf_blob.tftf_buf)
-                self.ffff_buf[span_start:span_end] = element.tftf_blob.tftf_buf
-                return True
-            else:
-                return False
+    def append_element(self, element):
+        """Append an initialized element to the element table
+
+        Returns a success flag.  The element record may be shared with the
+        other FFFF header, in which case its TFTF is only loaded and placed
+        in the ROMimage buffer once.
+        """
+        if len(self.elements) < FFFF_MAX_ELEMENTS:
+            self.elements.append(element)
+            return True
         else:
             error("too many elements")
             return False
@@ -217,58 +240,49 @@ class Ffff:
         self.duplicates_found = False
         self.invalid_elements_found = False
 
-        for i, elt_a in enumerate(self.elements):
-            collision = []
-            duplicate = []
-
-            if elt_a.element_type == FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
+        # Only the elements up to the end-of-table marker are checked
+        elements = []
+        for element in self.elements:
+            if element.element_type == FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
                 break
+            elements.append(element)
+
+        # Check for inter-element collisions and, per the specification,
+        # duplicates: "At most, one element table entry with a particular
+        # element type, element ID, and element genration may be present
+        # in the element table."
+        overlaps = find_overlaps([(element.element_location,
+                                   element.element_length)
+                                  for element in elements])
+        duplicates = find_duplicates([(element.element_type,
+                                       element.element_id,
+                                       element.element_generation)
+                                      for element in elements])
+
+        for i, element in enumerate(elements):
+            collision = []
 
             # Check for an invalid element (i.e., either munged or
             # collides with the 2 FFFF header blocks
-            if not elt_a.validate(self.element_location_min,
-                                  self.element_location_max):
+            if not element.validate(self.element_location_min,
+                                    self.element_location_max):
                 self.invalid_elements_found = True
-            if elt_a.element_location < (2 * self.header_block_size()):
-                self.collisions_found = True
+            if element.element_location < (2 * self.header_block_size()):
                 collision += [FFFF_HEADER_COLLISION]
                 error("Element at location " + \
-                    format(elt_a.element_location, "#x") + \
+                    format(element.element_location, "#x") + \
                     " collides with two header blocks of size " + \
                     format(2 * self.header_block_size(), "#x"))
+            collision += overlaps[i]
+            if collision:
+                self.collisions_found = True
+            if duplicates[i]:
+                self.duplicates_found = True
 
-            for j, elt_b in enumerate(self.elements):
-                # skip checking one's self
-                if i != j:
-                    # extract elements[j]
-                    if elt_b.element_type == \
-                            FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
-                        break
-
-                    # check for collision
-                    elt_a.validate_against(elt_b)
-                    start_a = elt_a.element_location
-                    end_a = start_a + elt_a.element_length - 1
-                    start_b = elt_b.element_location
-                    end_b = start_b + elt_b.element_length - 1
-                    if end_b >= start_a and start_b <= end_a:
-                        self.collisions_found = True
-                        collision += [j]
-
-                    # check for other duplicate entries
-                    # Per the specification: "At most, one element table
-                    # entry with a particular element type, element ID,
-                    # and element genration may be present in the element
-                    # table."
-                    if elt_a.element_type == elt_b.element_type and \
-                       elt_a.element_id == elt_b.element_id and \
-                       elt_a.element_generation == \
-                       elt_b.element_generation:
-                        self.duplicatess_found = True
-                        duplicate += [j]
-
+            element.collisions = collision
+            element.duplicates = duplicates[i]
             self.collisions += [collision]
-            self.duplicates += [duplicate]
+            self.duplicates += [duplicates[i]]
         if self.collisions_found:
             error("Found collisions in FFFF element table!")
         if self.duplicates_found:
@@ -279,6 +293,7 @@ class Ffff:
             not self.duplicates_found and \
             not self.invalid_elements_found
 
+    @timed("ffff.validate")
     def validate_ffff_header(self):
         # Perform a quick validity check of the header.  Generally done when
         # importing an existing FFFF file.
@@ -330,12 +345,14 @@ class Ffff:
 
         return self.header_validity
 
-    def post_process(self, buf):
+    @timed("ffff.post_process")
+    def post_process(self, buf, timestamp=None):
         """Post-process the FFFF header
 
         Process the FFFF header, assigning unspecified element locations to
         be contiguous (on erase-block-size boundaries), and read the TFTF
-        files into the buffer at those locations.
+        files into the buffer at those locations.  The header is stamped
+        with the timestamp (see: util.get_timestamp).
 
         (Called by "create-ffff" after processing all arguments)
         """
@@ -364,12 +381,18 @@ class Ffff:
         if self.flash_image_length == 0:
             self.flash_image_length = location
 
+        # Now that the locations are settled, copy the TFTFs into the
+        # ROMimage buffer
+        if not self.sparse:
+            for element in self.elements:
+                element.place()
+
         self.validate_element_table()
 
         # fill in and/or trim selected FFFF fields
         self.sentinel = FFFF_SENTINEL
 
-        self.timestamp = strftime("%Y%m%d %H%M%S", gmtime())
+        self.timestamp = get_timestamp(timestamp)
         if self.flash_image_name:
             self.flash_image_name = \
                 self.flash_image_name[0:FFFF_FLASH_IMAGE_NAME_LENGTH]
@@ -445,6 +468,28 @@ class Ffff:
             if element.element_type == FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
                 break
 
+    def get_record(self):
+        """Return the FFFF header as a dictionary
+
+        This is the machine-readable counterpart of display(), holding the
+        header fields, the element table (with each element's collisions,
+        duplicates and TFTF header) and the header's validity.
+        """
+        return OrderedDict([
+            ("header_offset", self.header_offset),
+            ("validity", ffff_validity_names[self.header_validity]),
+            ("sentinel", c_string(self.sentinel)),
+            ("timestamp", c_string(self.timestamp)),
+            ("flash_image_name", c_string(self.flash_image_name)),
+            ("flash_capacity", self.flash_capacity),
+            ("erase_block_size", self.erase_block_size),
+            ("header_size", self.header_size),
+            ("flash_image_length", self.flash_image_length),
+            ("header_generation_number", self.header_generation_number),
+            ("tail_sentinel", c_string(self.tail_sentinel)),
+            ("elements", [element.get_record()
+                          for element in self.elements])])
+
     def display(self, header_index, display_element_data,
                 use_common_header, filename=None):
         """Display an FFFF header"""
@@ -0,0 +1,250 @@
+#! /usr/bin/env python
+
+#
+# Copyright (c) 2015 Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Erase-block deltas between FFFF images
+
+A delta holds the erase blocks of a new FFFF image which differ from an
+old one, so that only those blocks need be transferred and reflashed.
+It consists of a header (FFFF_DELTA_HEADER) followed by a record
+(FFFF_DELTA_BLOCK) for each changed block, in block order.  A block which
+is entirely erased (0xff) or zeroed is recorded as a fill; any other
+block is followed by its contents.  The header carries the SHA-256
+digests of both images, so that a delta is only applied to the image it
+was made from.
+"""
+
+from __future__ import print_function
+import io
+import os
+import hashlib
+import struct
+from ffff_romimage import FfffRomimage
+from layout import FFFF_DELTA_HEADER, FFFF_DELTA_BLOCK
+from util import error, find_non_fill, write_fill, update_digest, \
+    read_chunks
+from profiling import timed, count
+
+FFFF_DELTA_SENTINEL = "FFFFDeltaFormat1"
+FFFF_DELTA_FILE_EXTENSION = ".delta"
+
+# Block record kinds
+FFFF_DELTA_BLOCK_DATA = 0
+FFFF_DELTA_BLOCK_FILL = 1
+
+# Fill bytes recorded as fills rather than data
+FFFF_DELTA_FILL_BYTES = (0xff, 0x00)
+
+# Size of the reads in which the images are compared (a whole number of
+# erase blocks)
+FFFF_DELTA_READ_SIZE = 1024 * 1024
+
+
+def get_erase_block_size(filename):
+    # Return the erase block size from an FFFF file's header, or None if
+    # it isn't a valid FFFF file (only the headers are read)
+    ffff_romimage = FfffRomimage()
+    if not ffff_romimage.init_from_file(filename, probe=True):
+        return None
+    return ffff_romimage.erase_block_size
+
+
+def diff_blocks(old_file, new_file, block_size, old_digest, new_digest):
+    """Yield the erase blocks of the new image which differ from the old
+
+    The images are read in step, FFFF_DELTA_READ_SIZE bytes at a time, and
+    only the reads which differ are compared block by block.  Yields the
+    block index and contents for each changed block, feeding both images
+    into their digests as it goes.
+    """
+    read_size = max(block_size,
+                    FFFF_DELTA_READ_SIZE - FFFF_DELTA_READ_SIZE % block_size)
+    index = 0
+    while True:
+        old = old_file.read(read_size)
+        new = new_file.read(read_size)
+        count("bytes_read", len(old) + len(new))
+        old_digest.update(old)
+        if not new:
+            break
+        new_digest.update(new)
+        if old != new:
+            for offset in range(0, len(new), block_size):
+                block = new[offset:offset + block_size]
+                if old[offset:offset + block_size] != block:
+                    yield index + offset / block_size, block
+        index += read_size / block_size
+
+    # Digest the rest of a longer old image
+    update_digest(old_digest, read_chunks(old_file, read_size))
+
+
+@timed("delta.diff")
+def diff_ffff(old_filename, new_filename, delta_filename):
+    """Write the erase-block delta between two FFFF images
+
+    The images must have the same erase block size.  Returns the number
+    of changed blocks and the number of blocks in the new image, or None
+    on failure.
+    """
+    block_size = get_erase_block_size(new_filename)
+    if not block_size:
+        error("Can't read FFFF file", new_filename)
+        return None
+    if get_erase_block_size(old_filename) != block_size:
+        error(old_filename, "doesn't have the erase block size of",
+              new_filename)
+        return None
+
+    old_digest = hashlib.sha256()
+    new_digest = hashlib.sha256()
+    num_blocks = 0
+    try:
+        with io.open(old_filename, 'rb') as old_file, \
+             io.open(new_filename, 'rb') as new_file, \
+             io.open(delta_filename, 'wb') as wf:
+            # (The header is written once the counts and digests are known)
+            wf.seek(FFFF_DELTA_HEADER.size)
+            for index, block in diff_blocks(old_file, new_file, block_size,
+                                            old_digest, new_digest):
+                for fill_byte in FFFF_DELTA_FILL_BYTES:
+                    if find_non_fill(block, fill_byte) < 0:
+                        wf.write(FFFF_DELTA_BLOCK.pack(
+                            index, FFFF_DELTA_BLOCK_FILL, fill_byte))
+                        break
+                else:
+                    wf.write(FFFF_DELTA_BLOCK.pack(
+                        index, FFFF_DELTA_BLOCK_DATA, 0))
+                    wf.write(block)
+                num_blocks += 1
+            count("bytes_written", wf.tell())
+
+            old_length = old_file.tell()
+            new_length = new_file.tell()
+            wf.seek(0)
+            wf.write(FFFF_DELTA_HEADER.pack(FFFF_DELTA_SENTINEL, block_size,
+                                            old_length, new_length,
+                                            num_blocks, old_digest.digest(),
+                                            new_digest.digest()))
+    except IOError as e:
+        error(e)
+        return None
+    print("Wrote", delta_filename)
+    return num_blocks, (new_length + block_size - 1) / block_size
+
+
+def digest_file(filename):
+    # Return the SHA-256 digest of a file
+    with io.open(filename, 'rb') as rf:
+        digest = update_digest(hashlib.sha256(),
+                               read_chunks(rf, FFFF_DELTA_READ_SIZE))
+        count("bytes_read", rf.tell())
+    return digest.digest()
+
+
+def check_delta_blocks(rf, num_blocks, block_size, new_length):
+    # Check that a delta holds all of its block records, each within the
+    # new image and (for data) with all of its contents, so that a cut-off
+    # or corrupt delta is caught before anything is written.  The delta
+    # file is read from (and left at) the end of its header.
+    start = rf.tell()
+    delta_length = os.fstat(rf.fileno()).st_size
+    for i in range(num_blocks):
+        record = rf.read(FFFF_DELTA_BLOCK.size)
+        if len(record) != FFFF_DELTA_BLOCK.size:
+            return False
+        index, kind, fill_byte = FFFF_DELTA_BLOCK.unpack(record)
+        location = index * block_size
+        if location >= new_length:
+            return False
+        if kind == FFFF_DELTA_BLOCK_DATA:
+            length = min(block_size, new_length - location)
+            if rf.tell() + length > delta_length:
+                return False
+            rf.seek(length, io.SEEK_CUR)
+        elif kind != FFFF_DELTA_BLOCK_FILL:
+            return False
+    rf.seek(start)
+    return True
+
+
+@timed("delta.apply")
+def apply_ffff_delta(delta_filename, filename):
+    """Apply an FFFF delta to an image file in place
+
+    The file must be the delta's old image, which is checked (by digest)
+    before anything is written, as is the delta itself (see:
+    check_delta_blocks).  Only the changed blocks are written, and
+    the file is then checked against the new image's digest.  Returns the
+    number of blocks written, or None on failure.
+    """
+    try:
+        with io.open(delta_filename, 'rb') as rf:
+            header = rf.read(FFFF_DELTA_HEADER.size)
+            if len(header) < FFFF_DELTA_HEADER.size or \
+               FFFF_DELTA_HEADER.unpack(header)[0] != FFFF_DELTA_SENTINEL:
+                error(delta_filename, "isn't an FFFF delta")
+                return None
+            sentinel, block_size, old_length, new_length, num_blocks, \
+                old_digest, new_digest = FFFF_DELTA_HEADER.unpack(header)
+
+            if os.path.getsize(filename) != old_length or \
+               digest_file(filename) != old_digest:
+                error("The delta doesn't apply to", filename)
+                return None
+            if not check_delta_blocks(rf, num_blocks, block_size,
+                                      new_length):
+                error(delta_filename, "is truncated or corrupt")
+                return None
+
+            with io.open(filename, 'r+b') as wf:
+                for i in range(num_blocks):
+                    index, kind, fill_byte = FFFF_DELTA_BLOCK.unpack(
+                        rf.read(FFFF_DELTA_BLOCK.size))
+                    location = index * block_size
+                    length = min(block_size, new_length - location)
+                    wf.seek(location)
+                    if kind == FFFF_DELTA_BLOCK_FILL:
+                        write_fill(wf, length, fill_byte, overwrite=True)
+                    else:
+                        block = rf.read(length)
+                        if len(block) != length:
+                            error(delta_filename, "is truncated")
+                            return None
+                        wf.write(block)
+                    count("bytes_written", length)
+                wf.truncate(new_length)
+    except (IOError, struct.error) as e:
+        error(e)
+        return None
+
+    if digest_file(filename) != new_digest:
+        error(filename, "doesn't match the delta's new image")
+        return None
+    return num_blocks
@@ -29,9 +29,11 @@
 #
 
 from __future__ import print_function
-from struct import unpack_from, pack_into
+from collections import OrderedDict
 from tftf import Tftf
-from util import error, block_aligned
+from util import error, block_aligned, buffer_view
+from layout import FFFF_ELEMENT_DESCRIPTOR, FFFF_MAX_ELEMENTS
+from profiling import timed
 
 
 # TFTF Sentinel value.
@@ -42,7 +44,6 @@ FFFF_SENTINEL_LENGTH_IN_BYTES = 16
 FFFF_TIMESTAMP_LENGTH = 16
 FFFF_FLASH_IMAGE_NAME_LENGTH = 48
 FFFF_HDR_LENGTH = 512
-FFFF_MAX_ELEMENTS = 19
 FFFF_PADDING = 16
 
 # Maximum possible size for a header block
@@ -91,16 +92,27 @@ FFFF_FILE_EXTENSION = ".ffff"
 FFFF_HDR_VALID = 0
 FFFF_HDR_ERASED = 1
 FFFF_HDR_INVALID = 2
+ffff_validity_names = {
+    FFFF_HDR_VALID: "valid",
+    FFFF_HDR_ERASED: "erased",
+    FFFF_HDR_INVALID: "invalid",
+}
 
 
 # FFFF Element representation
 #
-class FfffElement:
+class FfffElement(object):
     """Defines the contents of a Flash Format for Firmware (FFFF) element table
 
     Each element describes a region of flash memory, its type and the
     corresponding blob stored there (typically a TFTF "file").
     """
+    __slots__ = ("filename", "_tftf_blob", "tftf_span", "tftf_cache",
+                 "placed_location", "buf_loader", "buf", "buf_size",
+                 "index", "erase_block_size", "collisions", "duplicates",
+                 "in_range", "aligned", "valid_type", "element_type",
+                 "element_id", "element_generation", "element_location",
+                 "element_length")
 
     def __init__(self, index, buf, buf_size, erase_block_size,
                  element_type, element_id, element_generation,
@@ -113,7 +125,11 @@ class FfffElement:
 
         # Private vars
         self.filename = filename
-        self.tftf_blob = None
+        self._tftf_blob = None
+        self.tftf_span = None
+        self.tftf_cache = None
+        self.placed_location = None
+        self.buf_loader = None
         self.buf = buf
         self.buf_size = buf_size
         self.index = index
@@ -141,10 +157,11 @@ class FfffElement:
         success = True
         # Try to size it from the TFTF file
         if self.filename and not self.tftf_blob:
-            # Create a TFTF blob and load the contents from the specified
+            # Create a TFTF blob and map the contents of the specified
             # TFTF file
-            self.tftf_blob = Tftf(self.filename)
-            success = self.tftf_blob.load_tftf_file(self.filename)
+            self._tftf_blob = Tftf(None)
+            success = self._tftf_blob.load_tftf_file(self.filename,
+                                                     use_mmap=True)
             if success and self.tftf_blob.is_good():
                 # element_length must be that of the entire TFTF blob,
                 # not just the TFTF's "load_length" or "expanded_length".
@@ -154,6 +171,21 @@ class FfffElement:
                 success = False
         return success
 
+    @timed("ffff.place")
+    def place(self):
+        """Copy the element's TFTF file into the FFFF buffer
+
+        Copies the TFTF loaded by init() into the buffer at the element
+        location.  This is done only once per location, so an element shared
+        by both FFFF headers is copied only once.
+        """
+        if self.filename and self._tftf_blob and \
+           self.placed_location != self.element_location:
+            span_start = self.element_location
+            span_end = span_start + self._tftf_blob.tftf_length
+            self.buf[span_start:span_end] = self._tftf_blob.tftf_buf
+            self.placed_location = self.element_location
+
     def unpack(self, buf, offset):
         """Unpack an element header from an FFFF header buffer
 
@@ -161,39 +193,77 @@ class FfffElement:
         offset.  Returns a flag indicating if the unpacked element is an
         end-of-table marker
         """
-        element_hdr = unpack_from("<LLLLL", buf, offset)
+        return self.unpack_descriptor(
+            buf, FFFF_ELEMENT_DESCRIPTOR.unpack_from(buf, offset))
+
+    def unpack_descriptor(self, buf, element_hdr):
+        """Set the element header from its unpacked fields
+
+        Takes the fields of an element header already unpacked from the
+        FFFF header buffer (see: Ffff.unpack).  Returns a flag indicating
+        if the element is an end-of-table marker
+        """
         self.element_type = element_hdr[0]
         self.element_id = element_hdr[1]
         self.element_generation = element_hdr[2]
         self.element_location = element_hdr[3]
         self.element_length = element_hdr[4]
 
-        # Get the element data into our tftf_blob
+        # Note where the element data lies, to be parsed into our
+        # tftf_blob if and when it is needed
         if self.element_type != FFFF_ELEMENT_END_OF_ELEMENT_TABLE:
-            # Create a TFTF blob and load the contents from the specified
-            # TFTF file
-            span_start = self.element_location
-            span_end = span_start + self.element_length
-            self.tftf_blob = Tftf(None)
-            span_start = self.element_location
-            span_end = span_start + self.element_length
-            self.tftf_blob.load_tftf_from_buffer(buf[span_start:span_end])
+            self.buf = buf
+            self._tftf_blob = None
+            self.tftf_span = (self.element_location, self.element_length)
             return False
         else:
             return True
 
+    @property
+    def tftf_blob(self):
+        """The element's TFTF
+
+        For an element unpacked from an FFFF buffer, the TFTF is parsed
+        from a view onto the buffer the first time it is accessed.  If a
+        tftf_cache (dictionary) is supplied, elements in different FFFF
+        headers which describe the same span share the same Tftf.
+        """
+        if not self._tftf_blob and self.tftf_span:
+            self.load_buf()
+            if self.tftf_cache is not None and \
+               self.tftf_span in self.tftf_cache:
+                self._tftf_blob = self.tftf_cache[self.tftf_span]
+            else:
+                span_start, span_length = self.tftf_span
+                self._tftf_blob = Tftf(None)
+                self._tftf_blob.load_tftf_from_buffer(
+                    buffer_view(self.buf, span_start, span_length))
+                if self.tftf_cache is not None:
+                    self.tftf_cache[self.tftf_span] = self._tftf_blob
+        return self._tftf_blob
+
+    def load_buf(self):
+        # Swap a header-only buffer for one holding the element data.
+        #
+        # Elements unpacked from a probed FFFF file (see:
+        # FfffRomimage.init_from_file) have a buf_loader which reads in
+        # the rest of the file.
+        if self.buf_loader:
+            self.buf = self.buf_loader()
+            self.buf_loader = None
+
     def pack(self, buf, offset):
         """Pack an element header into an FFFF header
 
         Packs an element header into into the FFFF header buffer at the
         specified offset and returns the offset for the next element
         """
-        pack_into("<LLLLL", buf, offset,
-                  self.element_type,
-                  self.element_id,
-                  self.element_generation,
-                  self.element_location,
-                  self.element_length)
+        FFFF_ELEMENT_DESCRIPTOR.pack_into(buf, offset,
+                                          self.element_type,
+                                          self.element_id,
+                                          self.element_generation,
+                                          self.element_location,
+                                          self.element_length)
         return offset + FFFF_ELT_LENGTH
 
     def validate(self, address_range_low, address_range_high):
@@ -256,6 +326,7 @@ class FfffElement:
         the specified file and return a success flag.
         """
 
+        self.load_buf()
         try:
             # Output the entire FFFF element blob (less padding)
             with open(filename, 'wb') as wf:
@@ -287,6 +358,29 @@ class FfffElement:
             name = "?"
         return name
 
+    def get_record(self):
+        # Return the element header, its validity and its TFTF's header
+        # as a dictionary (see: Ffff.get_record)
+
+        if self.tftf_blob:
+            tftf_record = self.tftf_blob.get_record()
+        else:
+            tftf_record = None
+        return OrderedDict([
+            ("index", self.index),
+            ("element_type", self.element_type),
+            ("element_name", self.element_name(self.element_type)),
+            ("element_id", self.element_id),
+            ("element_generation", self.element_generation),
+            ("element_location", self.element_location),
+            ("element_length", self.element_length),
+            ("collisions", self.collisions),
+            ("duplicates", self.duplicates),
+            ("in_range", self.in_range),
+            ("aligned", self.aligned),
+            ("valid_type", self.valid_type),
+            ("tftf", tftf_record)])
+
     def display_table_header(self):
         # Print the element table column names
         print("     Type       ID         Generation Location   Length")
@@ -312,13 +406,13 @@ class FfffElement:
         # Note any collisions and duplicates on separate lines
         if len(self.collisions) > 0:
             element_string = "           Collides with element(s):"
-            for collision in self.collisions[self.index]:
+            for collision in self.collisions:
                 element_string += " {0:d}".format(collision)
             print(element_string)
 
         if len(self.duplicates) > 0:
             element_string = "           Duplicates element(s):"
-            for duplicate in self.duplicates[self.index]:
+            for duplicate in self.duplicates:
                 element_string += " {0:d}".format(duplicate)
             print(element_string)
 
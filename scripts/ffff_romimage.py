@@ -30,13 +30,19 @@
 
 from __future__ import print_function
 from string import rfind
-from struct import unpack_from
 from ffff_element import FFFF_MAX_HEADER_BLOCK_OFFSET, FFFF_SENTINEL, \
     FFFF_MAX_HEADER_BLOCK_SIZE, FFFF_HDR_OFF_TAIL_SENTINEL, \
     FFFF_FILE_EXTENSION, FFFF_HDR_LENGTH, FFFF_HDR_VALID
 from ffff import Ffff
-from util import error, is_power_of_2
+from ffff_element import FfffElement
+from tftf import Tftf
+from util import error, is_power_of_2, write_fill, c_string, get_timestamp
+from layout import FFFF_HEADER, FFFF_TAIL_SENTINEL, FFFF_SENTINELS
+from profiling import timed, count
 import io
+from collections import OrderedDict
+from copy import copy
+
 
 # FFFF ROMimage representation
 #
@@ -54,7 +60,12 @@ class FfffRomimage:
         self.ffff0 = None
         self.ffff1 = None
         self.ffff_buf = None
+        self.sparse = False
+        self.fill_byte = 0
         self.mv = None
+        self.filename = None
+        self.probed = False
+        self.second_header_offset = 0
         self.flash_image_name = None
         self.flash_capacity = 0
         self.erase_block_size = 0
@@ -64,13 +75,19 @@ class FfffRomimage:
         self.element_location_max = 0
 
     def init(self, flash_image_name, flash_capacity, erase_block_size,
-             image_length, header_generation_number):
+             image_length, header_generation_number, sparse=False,
+             fill_byte=0):
         """"FFFF post-constructor initializer for a new FFFF
 
         FFFF post-constructor initializer for creating an FFFF (as opposed
         to reading an existing one from a file), and returns a success flag.
         The FFFF ROMimage buffer is sized explicitly from the image_length
         parameter.
+
+        If sparse is set, the buffer only covers the two header blocks.
+        The elements are then written straight from their TFTF files, and
+        the gaps between the headers and elements are either left as holes
+        (a sparse file) or, for a non-zero fill_byte, filled.
         """
         # Validate the parameters
         if not is_power_of_2(erase_block_size):
@@ -91,25 +108,35 @@ class FfffRomimage:
         self.element_location_max = image_length
 
         # Resize the ROMimage buffer to the correct size
-        self.ffff_buf = bytearray(image_length)
+        self.sparse = sparse
+        self.fill_byte = fill_byte
+        if sparse:
+            self.ffff_buf = bytearray(2 * self.header_block_size())
+        else:
+            self.ffff_buf = bytearray(image_length)
         #self.mv = memoryview(self.ffff_buf)
 
         # Create the 2 FFFF headers
         self.ffff0 = Ffff(self.ffff_buf, 0, flash_image_name,
                           flash_capacity, erase_block_size,
-                          image_length, header_generation_number)
+                          image_length, header_generation_number, sparse)
         self.ffff1 = Ffff(self.ffff_buf, self.header_block_size(),
                           flash_image_name, flash_capacity,
                           erase_block_size, image_length,
-                          header_generation_number)
+                          header_generation_number, sparse)
         return True
 
-    def init_from_file(self, filename):
+    @timed("romimage.load")
+    def init_from_file(self, filename, probe=False):
         """"FFFF post-constructor initializer to read an FFFF from file
 
         Distinct from "init" above, this reads in an existing FFFF file
         and parses it, returning a success flag. The FFFF ROMimage buffer
         is sized to the supplied file.
+
+        If probe is set, only the FFFF headers are read from the file (e.g.,
+        to check the header generation numbers), and the rest of the file
+        is only read (see: load_element_data) if element data is needed.
         """
         success = True
         if filename:
@@ -120,6 +147,7 @@ class FfffRomimage:
             for i in range(len(names)):
                 try:
                     rf = io.open(names[i], 'rb')
+                    self.filename = names[i]
                     break
                 except:
                     rf = None
@@ -128,66 +156,125 @@ class FfffRomimage:
                 error(" can't find FFFF file", filename)
                 return False
 
-            try:
-                # Read the FFFF file.
-                rf.seek(0, 2)
-                read_size = rf.tell()
+            def read_header(offset, from_file=probe):
+                # Read the FFFF header at offset from the file, or pick it
+                # out of the buffer if that holds the whole file
+                if from_file:
+                    rf.seek(offset, 0)
+                    return rf.read(FFFF_HDR_LENGTH)
+                return self.ffff_buf[offset:offset + FFFF_HDR_LENGTH]
 
-                # Resize the buffer to hold the file
-                self.ffff_buf = bytearray(read_size)
-                rf.seek(0, 0)
-                rf.readinto(self.ffff_buf)
-                rf.close()
+            try:
+                if probe:
+                    # Read just the 1st FFFF header
+                    self.ffff_buf = bytearray(read_header(0))
+                    self.probed = True
+                    count("bytes_read", len(self.ffff_buf))
+                else:
+                    # Read the FFFF file.
+                    rf.seek(0, 2)
+                    read_size = rf.tell()
+
+                    # Resize the buffer to hold the file
+                    self.ffff_buf = bytearray(read_size)
+                    rf.seek(0, 0)
+                    rf.readinto(self.ffff_buf)
+                    count("bytes_read", read_size)
 
                 if not self.get_romimage_characteristics():
                     error("invalid file")
                     return False
 
-                # Create the 1st FFFF header/object
-                #self.mv = memoryview(self.ffff_buf)
+                # Scan for 2nd header
+                offset, header = self.find_second_header(read_header)
+                if not header:
+                    error("can't find the 2nd FFFF header in", filename)
+                    return False
+                self.second_header_offset = offset
+                if probe:
+                    # Lay the headers out as they are in the file
+                    headers = bytearray(offset + FFFF_HDR_LENGTH)
+                    headers[0:FFFF_HDR_LENGTH] = self.ffff_buf
+                    headers[offset:] = header
+                    self.ffff_buf = headers
+                    count("bytes_read", len(header))
+
+                # Create the FFFF header/objects. (Both headers share the
+                # element TFTFs they have in common.)
+                tftf_cache = {}
                 self.ffff0 = Ffff(self.ffff_buf, 0,
                                   self.flash_image_name,
                                   self.flash_capacity,
                                   self.erase_block_size,
                                   self.flash_image_length,
                                   self.header_generation_number)
-                self.ffff0.unpack()
+                self.ffff0.unpack(tftf_cache)
+                self.ffff1 = Ffff(self.ffff_buf, offset,
+                                  self.flash_image_name,
+                                  self.flash_capacity,
+                                  self.erase_block_size,
+                                  self.flash_image_length,
+                                  self.header_generation_number)
+                self.ffff1.unpack(tftf_cache)
 
-                # Scan for 2nd header
-                offset = self.header_block_size()
-                while offset < FFFF_MAX_HEADER_BLOCK_OFFSET:
-                    # Unpack and validate the nose and tail sentinels
-                    ffff_hdr = unpack_from("<16s", self.ffff_buf,
-                                           offset)
-                    nose_sentinel = ffff_hdr[0]
-                    ffff_hdr = unpack_from("<16s", self.ffff_buf,
-                                           offset +
-                                           FFFF_HDR_OFF_TAIL_SENTINEL)
-                    tail_sentinel = ffff_hdr[0]
-
-                    # Create the 2nd FFFF header/object?
-                    if nose_sentinel == FFFF_SENTINEL and \
-                            tail_sentinel == FFFF_SENTINEL:
-                        self.header_block_size = offset
-                        self.ffff1 = Ffff(self.ffff_buf, offset,
-                                          self.flash_image_name,
-                                          self.flash_capacity,
-                                          self.erase_block_size,
-                                          self.flash_image_length,
-                                          self.header_generation_number)
-                        self.ffff1.unpack()
-                        break
-                    else:
-                        offset <<= 1
+                # Have probed elements read the rest of the file on demand
+                if probe:
+                    for ffff in (self.ffff0, self.ffff1):
+                        for element in ffff.elements:
+                            element.buf_loader = self.load_element_data
             except:
                 error("can't read", filename)
                 success = False
+            finally:
+                rf.close()
         else:
             error("no file specified")
             success = False
 
         return success
 
+    def find_second_header(self, read_header):
+        # Scan the candidate header-block offsets for the 2nd FFFF header.
+        #
+        # read_header(offset) returns the FFFF_HDR_LENGTH bytes at offset,
+        # whose sentinels are then checked in one go.  Returns the offset
+        # and contents of the 2nd header, or (None, None) if not found.
+        offset = self.header_block_size()
+        while offset < FFFF_MAX_HEADER_BLOCK_OFFSET:
+            header = read_header(offset)
+            if len(header) < FFFF_HDR_LENGTH:
+                # We've run off the end of the file
+                break
+            nose_sentinel, tail_sentinel = FFFF_SENTINELS.unpack_from(header)
+            if nose_sentinel == FFFF_SENTINEL and \
+                    tail_sentinel == FFFF_SENTINEL:
+                return offset, header
+            offset <<= 1
+        return None, None
+
+    @timed("romimage.load_element_data")
+    def load_element_data(self):
+        """Read the remainder of a probed FFFF file
+
+        Replaces the header-only buffer read by init_from_file's probe mode
+        with the contents of the entire file, and returns the new buffer.
+        """
+        if self.probed:
+            with io.open(self.filename, 'rb') as rf:
+                rf.seek(0, 2)
+                buf = bytearray(rf.tell())
+                rf.seek(0, 0)
+                rf.readinto(buf)
+            count("bytes_read", len(buf))
+            self.ffff_buf = buf
+            for ffff in (self.ffff0, self.ffff1):
+                ffff.ffff_buf = buf
+                for element in ffff.elements:
+                    element.buf = buf
+                    element.buf_loader = None
+            self.probed = False
+        return self.ffff_buf
+
     def header_block_size(self):
         # Determine the size of the FFFF header block, defined as a
         # power-of-2 * the erase-block-size
@@ -200,7 +287,7 @@ class FfffRomimage:
         # header in the buffer.
 
         # Unpack the fixed part of the header
-        ffff_hdr = unpack_from("<16s16s48sLLLLL", self.ffff_buf)
+        ffff_hdr = FFFF_HEADER.unpack_from(self.ffff_buf)
         sentinel = ffff_hdr[0]
         self.timestamp = ffff_hdr[1]
         self.flash_image_name = ffff_hdr[2]
@@ -211,8 +298,8 @@ class FfffRomimage:
         self.header_generation_number = ffff_hdr[7]
 
         # Unpack the 2nd sentinel at the tail
-        ffff_hdr = unpack_from("<16s", self.ffff_buf,
-                               FFFF_HDR_OFF_TAIL_SENTINEL)
+        ffff_hdr = FFFF_TAIL_SENTINEL.unpack_from(self.ffff_buf,
+                                                  FFFF_HDR_OFF_TAIL_SENTINEL)
         tail_sentinel = ffff_hdr[0]
 
         # Verify the sentinels
@@ -240,32 +327,162 @@ class FfffRomimage:
         # TFTF file into the ROMimage buffer.  This is called for FFFF
         # creation, and adds the element to both FFFF headers.  It returns
         # a success flag
+        #
+        # Both headers share the same element record, so that the TFTF file
+        # is read, and placed in the ROMimage buffer (by post_process), only
+        # once.
         if self.ffff0 and self.ffff1:
-            return \
-                self.ffff0.add_element(element_type, element_id,
-                                       element_generation,
-                                       element_location, element_length,
-                                       filename) and \
-                self.ffff1.add_element(element_type, element_id,
-                                       element_generation,
-                                       element_location, element_length,
-                                       filename)
+            element = FfffElement(len(self.ffff0.elements),
+                                  self.ffff_buf,
+                                  self.flash_capacity,
+                                  self.erase_block_size,
+                                  element_type,
+                                  element_id,
+                                  element_generation,
+                                  element_location,
+                                  element_length,
+                                  filename)
+            return element.init() and \
+                self.ffff0.append_element(element) and \
+                self.ffff1.append_element(element)
         else:
             error("No FFFF in which to add element")
             return False
 
-    def post_process(self):
+    @timed("romimage.post_process")
+    def post_process(self, timestamp=None):
         """Post-process the FFFF header
 
-        Reads the TFTF files into the ROMimage buffer for both FFFF headers.
+        Reads the TFTF files into the ROMimage buffer for both FFFF headers,
+        stamping them with the timestamp (see: util.get_timestamp).
         (Called by "create-ffff" after processing all arguments)
         """
         if self.ffff0 and self.ffff1:
-            self.ffff0.post_process(self.mv)
-            self.ffff1.post_process(self.mv)
+            self.ffff0.post_process(self.mv, timestamp)
+            self.ffff1.post_process(self.mv, timestamp)
         else:
             error("No FFFF to post-process")
 
+    @timed("romimage.replace_element")
+    def replace_element(self, element_type, element_id, filename,
+                        element_generation=None,
+                        header_generation_number=None, timestamp=None,
+                        fill_byte=0):
+        """Replace an element of an FFFF file in place
+
+        For a ROMimage read by init_from_file (which need only have probed
+        the headers), replaces the TFTF of the element of the given type
+        and ID in both FFFF headers with the TFTF in filename, and returns
+        a success flag.  Only the element's span (the new TFTF, with any
+        remainder of the old one overwritten with fill_byte) and the two
+        FFFF headers are written back to the file.  The headers get the
+        new element length (and generation, if specified), the timestamp
+        (see: util.get_timestamp) and the next header generation number
+        (or header_generation_number, if specified).
+        """
+        if not (self.filename and self.ffff0 and self.ffff1):
+            error("No FFFF file to update")
+            return False
+
+        tftf = Tftf(None)
+        if not tftf.load_tftf_file(filename, use_mmap=True) or \
+           not tftf.is_good():
+            error("Bad TFTF file:", filename)
+            return False
+
+        # Find the element in each header, noting the span(s) it covers
+        spans = {}
+        matched_elements = []
+        for ffff in (self.ffff0, self.ffff1):
+            matches = [element for element in ffff.elements
+                       if element.element_type == element_type and
+                       element.element_id == element_id]
+            if len(matches) != 1:
+                error("Found", len(matches), "elements of type",
+                      format(element_type, "#x"), "and ID",
+                      format(element_id, "#x"), "in", self.filename)
+                return False
+            element = matches[0]
+            spans[element.element_location] = \
+                max(element.element_length,
+                    spans.get(element.element_location, 0))
+            matched_elements.append(element)
+
+            # Make sure the new TFTF still fits, checking the element table
+            # with the element replaced on a copy of the header (so that a
+            # failure leaves this one as it was)
+            if element.element_location + tftf.tftf_length > \
+               self.flash_image_length:
+                error(filename, "doesn't fit in the image at",
+                      format(element.element_location, "#x"))
+                return False
+            trial = copy(ffff)
+            trial.elements = [copy(e) for e in ffff.elements]
+            replacement = trial.elements[ffff.elements.index(element)]
+            replacement.element_length = tftf.tftf_length
+            if element_generation is not None:
+                replacement.element_generation = element_generation
+            if not trial.validate_element_table():
+                return False
+
+        # Replace the element in both headers
+        for element in matched_elements:
+            element.element_length = tftf.tftf_length
+            if element_generation is not None:
+                element.element_generation = element_generation
+            element._tftf_blob = tftf
+            element.tftf_span = None
+
+        # Update the headers
+        if header_generation_number is None:
+            header_generation_number = self.header_generation_number + 1
+        self.header_generation_number = header_generation_number
+        timestamp = get_timestamp(timestamp)
+        for ffff in (self.ffff0, self.ffff1):
+            ffff.header_generation_number = header_generation_number
+            ffff.timestamp = timestamp
+            ffff.pack()
+
+        # Write the element span(s), then the headers
+        try:
+            with io.open(self.filename, 'r+b') as wf:
+                for location in sorted(spans):
+                    wf.seek(location)
+                    wf.write(tftf.tftf_buf)
+                    write_fill(wf, spans[location] - tftf.tftf_length,
+                               fill_byte, overwrite=True)
+                    count("bytes_written",
+                          max(spans[location], tftf.tftf_length))
+                for ffff in (self.ffff0, self.ffff1):
+                    wf.seek(ffff.header_offset)
+                    wf.write(self.ffff_buf[ffff.header_offset:
+                                           ffff.header_offset +
+                                           FFFF_HDR_LENGTH])
+                    count("bytes_written", FFFF_HDR_LENGTH)
+        except:
+            error("Failed to update", self.filename)
+            return False
+        print("Updated", self.filename)
+        return True
+
+    def get_record(self):
+        """Return the FFFF ROMimage as a dictionary
+
+        This is the machine-readable counterpart of display(): the
+        characteristics of the ROMimage (from the 1st FFFF header) and
+        the records for each of its FFFF headers.
+        """
+        headers = [ffff for ffff in (self.ffff0, self.ffff1) if ffff]
+        return OrderedDict([
+            ("flash_image_name", c_string(self.flash_image_name)),
+            ("flash_capacity", self.flash_capacity),
+            ("erase_block_size", self.erase_block_size),
+            ("flash_image_length", self.flash_image_length),
+            ("header_generation_number", self.header_generation_number),
+            ("identical", len(headers) == 2 and
+                          self.ffff0.same_as(self.ffff1)),
+            ("headers", [ffff.get_record() for ffff in headers])])
+
     def display(self, header_index, filename=None):
         """Display an FFFF header"""
 
@@ -276,6 +493,7 @@ class FfffRomimage:
         else:
             error("No FFFF to display")
 
+    @timed("romimage.write")
     def write(self, out_filename):
         """Create the FFFF file
 
@@ -299,13 +517,45 @@ class FfffRomimage:
         try:
             # Output the entire FFFF blob
             with open(out_filename, 'wb') as wf:
-                wf.write(self.ffff_buf)
+                if self.sparse:
+                    self.write_sparse(wf)
+                else:
+                    wf.write(self.ffff_buf)
+                count("bytes_written", wf.tell())
                 print("Wrote", out_filename)
                 return True
         except:
             error("Failed to write", out_filename)
             return False
 
+    def write_sparse(self, wf):
+        # Write a sparse FFFF ROMimage out to a file
+        #
+        # The populated extents (the two header blocks and the element
+        # TFTFs) are written in location order, and the gaps between them
+        # are left as holes or filled with the fill byte.  (Each header
+        # block is written whole, so that it is zero-padded after its
+        # header just as in a non-sparse image.)
+        extents = {}
+        for ffff in (self.ffff0, self.ffff1):
+            extents[ffff.header_offset] = \
+                self.ffff_buf[ffff.header_offset:
+                              ffff.header_offset + self.header_block_size()]
+            for element in ffff.elements:
+                if element.tftf_blob:
+                    extents[element.element_location] = \
+                        element.tftf_blob.tftf_buf
+
+        position = 0
+        for location in sorted(extents):
+            write_fill(wf, location - position, self.fill_byte)
+            wf.write(extents[location])
+            position = location + len(extents[location])
+        write_fill(wf, self.flash_image_length - position, self.fill_byte)
+
+        # Extend the file over any trailing hole
+        wf.truncate(self.flash_image_length)
+
     def explode(self, root_filename=None):
         """Write out the component elements
 
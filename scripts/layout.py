@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+
+#
+# Copyright (c) 2015 Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+"""Binary layouts of the TFTF, FFFF, signature block and delta structures
+
+Precompiled codecs for the fixed-format parts of the TFTF header, the FFFF
+header, the signature block and the FFFF delta file, so that the format
+strings are only parsed once.  The section and element descriptor tables
+are decoded in one go (see: TableCodec).
+"""
+
+from struct import Struct
+
+# The sizes of the TFTF section table and the FFFF element table
+TFTF_MAX_SECTIONS = 25
+FFFF_MAX_ELEMENTS = 19
+
+
+class TableCodec(object):
+    """A codec for a table of identical fixed-size records
+
+    Python 2's struct module has no iter_unpack, so the whole table is
+    decoded with a single precompiled Struct and then split into records.
+    """
+    __slots__ = ("record", "count", "fields_per_record", "table")
+
+    def __init__(self, record, count):
+        self.record = record
+        self.count = count
+        self.fields_per_record = len(record.unpack(bytearray(record.size)))
+        self.table = Struct(record.format[0] + record.format[1:] * count)
+
+    def iter_unpack(self, buf, offset=0):
+        """Yield the fields of each record in the table at offset, as tuples
+
+        Only the records which the buffer actually holds are decoded, so
+        a table cut short by the end of the buffer yields fewer records
+        (and the caller stops at the end-of-table marker in any case).
+        """
+        count = min(self.count, max(0, len(buf) - offset) // self.record.size)
+        if count == self.count:
+            table = self.table
+        else:
+            table = Struct(self.record.format[0] +
+                           self.record.format[1:] * count)
+        fields = table.unpack_from(buf, offset)
+        for i in range(0, len(fields), self.fields_per_record):
+            yield fields[i:i + self.fields_per_record]
+
+
+# TFTF header: the fixed part, and its separately-packed pieces (sentinel
+# and timestamp, firmware package name, lengths and IDs)
+TFTF_HEADER = Struct("<4s16s48sLLLLLLLL")
+TFTF_HEADER_ID = Struct("<4s16s")
+TFTF_HEADER_NAME = Struct("<48s")
+TFTF_HEADER_FIELDS = Struct("<LLLLLLLL")
+
+# TFTF section descriptor: section length, expanded length, copy offset and
+# section type, in a table of up to TFTF_MAX_SECTIONS descriptors
+TFTF_SECTION_DESCRIPTOR = Struct("<LLLL")
+TFTF_SECTION_TABLE = TableCodec(TFTF_SECTION_DESCRIPTOR, TFTF_MAX_SECTIONS)
+
+# The leading fields of a signature section, as broken down for display
+TFTF_SIGNATURE_SUMMARY = Struct("<LL64s")
+
+# FFFF header: the fixed part, and its separately-packed pieces (sentinel
+# and timestamp, flash image name, sizes and generation number)
+FFFF_HEADER = Struct("<16s16s48sLLLLL")
+FFFF_HEADER_ID = Struct("<16s16s")
+FFFF_HEADER_NAME = Struct("<48s")
+FFFF_HEADER_FIELDS = Struct("<LLLLL")
+FFFF_TAIL_SENTINEL = Struct("<16s")
+
+# Both FFFF sentinels (at 0x0000 and FFFF_HDR_OFF_TAIL_SENTINEL, 0x01f0),
+# for checking a candidate header in one go
+FFFF_SENTINELS = Struct("<16s480x16s")
+
+# FFFF element descriptor: element type, ID, generation, location and
+# length, in a table of up to FFFF_MAX_ELEMENTS descriptors
+FFFF_ELEMENT_DESCRIPTOR = Struct("<LLLLL")
+FFFF_ELEMENT_TABLE = TableCodec(FFFF_ELEMENT_DESCRIPTOR, FFFF_MAX_ELEMENTS)
+
+# Signature block: length, signature type and key name (the signature
+# itself follows)
+SIGNATURE_BLOCK = Struct("<LL96s")
+
+# FFFF delta file header: sentinel, erase block size, the lengths of the old
+# and new images, the number of block records and the SHA-256 digests of
+# the old and new images
+FFFF_DELTA_HEADER = Struct("<16sLLLL32s32s")
+
+# FFFF delta block record: erase block index, kind (data or fill) and fill
+# byte.  A data record is followed by the block's contents.
+FFFF_DELTA_BLOCK = Struct("<LBB2x")
@@ -0,0 +1,273 @@
+#! /usr/bin/env python
+
+#
+# Copyright (c) 2015 Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+"""Lightweight profiling for the TFTF/FFFF tools
+
+The major phases of the tools are wrapped in named timing spans (see: timed
+and span), and the bytes read and written are counted (see: count).  These
+are no-ops unless profiling is enabled, either with a tool's --profile or
+--profile-out options (see: add_profile_arguments) or by setting the
+BOOTROM_TOOLS_PROFILE environment variable.  The destination selects the
+output:
+
+    "-" (or "1")    Print a breakdown of the phases to stderr on exit
+    <file>.json     Write the spans to a Chrome trace-event format file
+    <file>          Write cProfile statistics (for pstats) to the file
+
+The spans and counters of worker processes (see: util.map_in_order) are
+merged into those of the main process, but cProfile statistics only cover
+the main process.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import atexit
+import cProfile
+from functools import wraps
+from timeit import default_timer
+
+# Environment variable which enables profiling
+PROFILE_ENV = "BOOTROM_TOOLS_PROFILE"
+
+# The active Profile, if profiling is enabled
+profile = None
+
+
+class Profile(object):
+    """Collected timing spans and counters"""
+
+    def __init__(self, destination):
+        self.destination = destination
+        self.start = default_timer()
+        self.events = []    # (path, start, duration), in completion order
+        self.stack = []     # names of the currently open spans
+        self.counters = {}
+        self.profiler = None
+        if destination not in ("-", "1") and \
+           not destination.endswith(".json"):
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def report(self):
+        # Write out the profile to its destination
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.destination)
+        elif self.destination.endswith(".json"):
+            self.write_trace()
+        else:
+            self.display()
+
+    def write_trace(self):
+        # Write the spans as Chrome trace events ("complete" events,
+        # timed in microseconds)
+        pid = os.getpid()
+        events = [{"name": path[-1],
+                   "cat": "/".join(path[:-1]),
+                   "ph": "X",
+                   "ts": int((start - self.start) * 1e6),
+                   "dur": int(duration * 1e6),
+                   "pid": pid,
+                   "tid": 0}
+                  for path, start, duration in self.events]
+        with open(self.destination, "w") as wf:
+            json.dump({"traceEvents": events,
+                       "otherData": self.counters}, wf)
+
+    def display(self):
+        # Print the time spent in each phase, nested by caller, and the
+        # counters to stderr
+        total = default_timer() - self.start
+        totals = {}
+        calls = {}
+        order = []
+        for path, start, duration in self.events:
+            if path not in totals:
+                totals[path] = 0.0
+                calls[path] = 0
+            totals[path] += duration
+            calls[path] += 1
+        # List each phase after its parent, in order of first use
+        for path, start, duration in sorted(self.events,
+                                            key=lambda event: event[1]):
+            if path not in order:
+                order.append(path)
+
+        print("Profile ({0:.3f}s):".format(total), file=sys.stderr)
+        print("  {0:40s} {1:>6s} {2:>10s} {3:>6s}".format(
+              "Phase", "Calls", "Seconds", "%"), file=sys.stderr)
+        for path in order:
+            print("  {0:40s} {1:6d} {2:10.4f} {3:6.1f}".format(
+                  "  " * (len(path) - 1) + path[-1], calls[path],
+                  totals[path], 100.0 * totals[path] / max(total, 1e-9)),
+                  file=sys.stderr)
+        for name in sorted(self.counters):
+            print("  {0:40s} {1:17d}".format(name, self.counters[name]),
+                  file=sys.stderr)
+
+
+class Span(object):
+    """A named timing span (use via span() or timed())"""
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        profile.stack.append(self.name)
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = default_timer() - self.start
+        profile.events.append((tuple(profile.stack), self.start, duration))
+        profile.stack.pop()
+        return False
+
+
+class NullSpan(object):
+    """The span used when profiling is disabled"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_SPAN = NullSpan()
+
+
+def span(name):
+    """Return a context manager timing a named phase"""
+    if profile:
+        return Span(name)
+    return NULL_SPAN
+
+
+def timed(name):
+    """Decorator timing each call of a function as a named phase"""
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profile:
+                return function(*args, **kwargs)
+            with Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, value):
+    """Add to a named counter (e.g., "bytes_read")"""
+    if profile:
+        profile.counters[name] = profile.counters.get(name, 0) + value
+
+
+class WorkerCall(object):
+    """A function run in a pool worker process, returning its profile too
+
+    Forked workers inherit the enabled profile, but the spans and counters
+    they collect would be lost when they exit.  Each call instead returns
+    the function's result along with the spans and counters collected
+    during the call, for merge_worker_results to add to the main profile.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, item):
+        profile.events = []
+        profile.stack = []
+        profile.counters = {}
+        result = self.function(item)
+        return result, profile.events, profile.counters
+
+
+def profile_workers(function):
+    """Wrap a function to be run by a process pool (see: WorkerCall)
+
+    Returns the function itself unless the spans are being profiled.
+    """
+    if profile and not profile.profiler:
+        return WorkerCall(function)
+    return function
+
+
+def merge_worker_results(results):
+    """Yield the results of WorkerCalls, merging in their profiles"""
+    for result, events, counters in results:
+        profile.events.extend(events)
+        for name, value in counters.items():
+            count(name, value)
+        yield result
+
+
+def enable_profiling(destination=None):
+    """Enable profiling, reporting to destination when the program exits
+
+    If destination is None, it is taken from the BOOTROM_TOOLS_PROFILE
+    environment variable, and profiling is only enabled if that is set.
+    """
+    global profile
+    if destination is None:
+        destination = os.environ.get(PROFILE_ENV)
+    if destination and not profile:
+        profile = Profile(destination)
+        atexit.register(profile.report)
+
+
+def add_profile_arguments(parser):
+    """Add the common --profile options to a tool's argument parser"""
+    parser.add_argument("--profile",
+                        action="store_true",
+                        help="Print a breakdown of where the time goes "
+                             "(including that of any worker processes)")
+
+    parser.add_argument("--profile-out",
+                        help="Write the profile to a .json trace file or, "
+                             "for any other name, a cProfile file")
+
+
+def init_profiling(args):
+    """Enable profiling as asked for by the --profile options
+
+    Without either option, profiling is enabled only if the
+    BOOTROM_TOOLS_PROFILE environment variable is set.
+    """
+    if args.profile_out:
+        enable_profiling(args.profile_out)
+    elif args.profile:
+        enable_profiling("-")
+    else:
+        enable_profiling()
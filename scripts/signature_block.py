@@ -29,8 +29,11 @@
 #
 
 from __future__ import print_function
-from struct import pack_into, unpack_from
+import os
+from string import rfind
+from stat import S_ISREG
 from util import display_binary_data, error
+from layout import SIGNATURE_BLOCK
 
 # TFTF Signature Block layout
 TFTF_SIGNATURE_KEY_NAME_LENGTH = 96
@@ -61,6 +64,50 @@ def get_key_type(key_type_string):
     return tftf_signature_types[key_type_string]
 
 
+def get_key_filename(filename):
+    # Add in any missing extension to the filename
+
+    # Check for the file, and if that fails, try appending the
+    # extension.
+    names = (filename, filename + ".pem")
+    for name in names:
+        try:
+            mode = os.stat(name).st_mode
+            if S_ISREG(mode):
+                return name
+        except:
+            # stat throws an exception for missing files.
+            continue
+
+    # Can't find the file in any of its variations
+    return None
+
+
+def get_key_name(key_filename, key_type):
+    # Derive the name of the key from the key's filename
+
+    offset = rfind(key_filename, ".")
+    if offset != -1:
+        key_name = key_filename[0:offset]
+    else:
+        key_name = key_filename
+    key_name += "@" + key_type + ".projectara.com"
+    return key_name
+
+
+def get_hash_from_signature_type(tftf_signature_type):
+    # Obtain the hash type from the signature type.
+    #
+    # Returns a string, suitable for Crypto.RSA.RSA.sign, identifying
+    # the hash algorithm to use. This makes the hash usage consistent
+    # with the supplied signature type.
+
+    if tftf_signature_type == TFTF_SIGNATURE_TYPE_RSA_2048_SHA_256:
+        return "sha256"
+    else:
+        return None
+
+
 class SignatureBlock:
     """TFTF signature block representation"""
 
@@ -92,17 +139,17 @@ class SignatureBlock:
         """
 
         buf = bytearray(self.length)
-        pack_into("<LL96s", buf, 0,
-                  self.length,
-                  self.signature_type,
-                  self.key_name)
+        SIGNATURE_BLOCK.pack_into(buf, 0,
+                                  self.length,
+                                  self.signature_type,
+                                  self.key_name)
         buf[TFTF_SIGNATURE_BLOCK_SIZE:self.length] = self.signature
         return buf
 
     def unpack(self, buf):
         """Unpack the signature block from a binary buffer"""
 
-        sig_block = unpack_from("<LL96s", buf, 0)
+        sig_block = SIGNATURE_BLOCK.unpack_from(buf, 0)
         self.length = sig_block[0]
         self.signature_type = sig_block[1]
         self.key_name = sig_block[2]
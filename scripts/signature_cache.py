@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+
+#
+# Copyright (c) 2015 Google Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from this
+# software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+# OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+from __future__ import print_function
+import os
+import hashlib
+from struct import pack
+from signature_block import SignatureBlock
+from util import error, create_temp_file, replace_file, evict_lru_files
+
+# Default upper bound on the size of the cache directory
+DEFAULT_SIGNATURE_CACHE_SIZE = 16 * 1024 * 1024
+
+SIGNATURE_CACHE_FILE_EXTENSION = ".sig"
+
+
+class SignatureCache:
+    """On-disk cache of TFTF signature blocks
+
+    Signatures are cached by the digest of the signable blob they sign,
+    together with the name of the key and the signature type, so that a
+    TFTF whose signable blob hasn't changed can be re-signed without the
+    private key.  Each signature block is stored in its own file in the
+    cache directory.  The cache is held under max_size bytes by evicting
+    the least-recently-used entries (each hit refreshes the entry's mtime).
+    """
+
+    def __init__(self, directory,
+                 max_size=DEFAULT_SIGNATURE_CACHE_SIZE):
+        """Constructor"""
+        self.directory = directory
+        self.max_size = max_size
+
+    def entry_filename(self, digest, key_name, signature_type):
+        # Return the name of the cache file for a signature
+
+        entry_hash = hashlib.sha256(digest)
+        entry_hash.update(pack("<L", signature_type))
+        entry_hash.update(key_name)
+        return os.path.join(self.directory,
+                            entry_hash.hexdigest() +
+                            SIGNATURE_CACHE_FILE_EXTENSION)
+
+    def get(self, digest, key_name, signature_type):
+        """Look up a signature block
+
+        Returns the cached SignatureBlock, or None on a cache miss.
+        """
+        filename = self.entry_filename(digest, key_name, signature_type)
+        try:
+            with open(filename, 'rb') as rf:
+                signature_block = SignatureBlock(bytearray(rf.read()))
+            os.utime(filename, None)
+        except:
+            return None
+
+        # Guard against a damaged entry
+        if signature_block.signature_type != signature_type or \
+           signature_block.key_name.rstrip("\0") != key_name:
+            return None
+        return signature_block
+
+    def put(self, digest, key_name, signature_type, signature_block):
+        """Add a signature block to the cache and return a success flag"""
+        filename = self.entry_filename(digest, key_name, signature_type)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            wf, temp_filename = create_temp_file(filename)
+            with wf:
+                wf.write(signature_block.pack())
+            replace_file(temp_filename, filename)
+        except:
+            error("Unable to cache signature in", self.directory)
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        # Evict the least-recently-used entries until the cache fits
+        # within its size limit
+        evict_lru_files(self.directory, SIGNATURE_CACHE_FILE_EXTENSION,
+                        self.max_size)
@@ -30,11 +30,19 @@
 
 from __future__ import print_function
 import os
+import mmap
 import binascii
-from struct import pack_into, unpack_from
+import hashlib
+import zlib
+from collections import OrderedDict
 from string import rfind
-from time import gmtime, strftime
-from util import display_binary_data, error
+from util import display_binary_data, error, buffer_view, find_overlaps, \
+    create_temp_file, replace_file, update_digest, c_string, get_timestamp
+from signature_block import SignatureBlock, get_hash_from_signature_type
+from profiling import timed, count
+from layout import TFTF_HEADER, TFTF_HEADER_ID, TFTF_HEADER_NAME, \
+    TFTF_HEADER_FIELDS, TFTF_SECTION_DESCRIPTOR, TFTF_SECTION_TABLE, \
+    TFTF_SIGNATURE_SUMMARY, TFTF_MAX_SECTIONS
 
 # TFTF section types
 TFTF_SECTION_TYPE_RESERVED = 0x00
@@ -71,6 +79,16 @@ countable_tftf_types = \
      TFTF_SECTION_TYPE_CERTIFICATE)
 
 
+# The raw counterparts of the compressed section types
+uncompressed_tftf_types = {
+    TFTF_SECTION_TYPE_COMPRESSED_CODE: TFTF_SECTION_TYPE_RAW_CODE,
+    TFTF_SECTION_TYPE_COMPRESSED_DATA: TFTF_SECTION_TYPE_RAW_DATA,
+}
+
+# Compressed sections are zlib streams, by default at the best compression
+TFTF_COMPRESSION_LEVEL = 9
+
+
 # Other TFTF header constants (mostly field sizes)
 TFTF_SENTINEL = "TFTF"
 TFTF_TIMESTAMP_LENGTH = 16
@@ -78,7 +96,6 @@ TFTF_FW_PKG_NAME_LENGTH = 48
 TFTF_HDR_LENGTH = 512
 TFTF_SECTION_HDR_LENGTH = 16
 TFTF_PADDING = 12
-TFTF_MAX_SECTIONS = 25
 
 # Offsets into the TFTF header
 TFTF_HDR_OFF_SENTINEL = 0x00
@@ -112,6 +129,11 @@ TFTF_FILE_EXTENSION = ".bin"
 TFTF_VALID = 0
 TFTF_INVALID = 1
 TFTF_VALID_WITH_COLLISIONS = 2
+tftf_validity_names = {
+    TFTF_VALID: "valid",
+    TFTF_INVALID: "invalid",
+    TFTF_VALID_WITH_COLLISIONS: "valid with collisions",
+}
 
 # Size of the blob to copy each time
 copy_blob_size = 1024*1024*10
@@ -129,31 +151,59 @@ section_names = {
 }
 
 
-class TftfSection:
+def compress_file(filename, skip=0, level=TFTF_COMPRESSION_LEVEL):
+    """Compress a file (less the first skip bytes) for a compressed section
+
+    The file is fed through a zlib compressor copy_blob_size bytes at a
+    time, so only the compressed data is ever held whole.  Returns the
+    compressed data and the uncompressed length.
+    """
+    compressor = zlib.compressobj(level)
+    chunks = []
+    expanded_length = 0
+    with open(filename, 'rb') as rf:
+        rf.seek(skip)
+        while True:
+            chunk = rf.read(copy_blob_size)
+            if not chunk:
+                break
+            expanded_length += len(chunk)
+            chunks.append(compressor.compress(chunk))
+    chunks.append(compressor.flush())
+    count("bytes_read", expanded_length)
+    return "".join(chunks), expanded_length
+
+
+class TftfSection(object):
     """TFTF Section representation"""
+    __slots__ = ("section_length", "expanded_length", "copy_offset",
+                 "section_type", "filename", "file_offset", "blob")
+
     def __init__(self, section_type, section_length=0,
-                 extended_length=0, copy_offset=0, filename=None):
+                 extended_length=0, copy_offset=0, filename=None,
+                 file_offset=0):
         """Constructor
 
-        If filename is specified, this reads in the file and sets the section
-        length to the length of the file.
+        If filename is specified, this sets the section length to the length
+        of the file, less the file_offset bytes skipped at its start.  (The
+        file itself is not read until the TFTF is written.)
         """
         self.section_length = section_length
         self.expanded_length = extended_length
         self.copy_offset = copy_offset
         self.section_type = section_type
         self.filename = filename
+        self.file_offset = file_offset
+        self.blob = None
 
         # Try to size the section length from the section input file
+        # (Compressed sections are added from a blob, with an expanded_length
+        # of the uncompressed size: see Tftf.add_compressed_section_from_file)
         if filename:
             try:
                 statinfo = os.stat(filename)
-                # TODO: Lengths will be different if/when we support
-                # compression:
-                # - section_length will shrink to the compressed size
-                # - expanded_length will remain the input file length
-                self.section_length = statinfo.st_size
-                self.expanded_length = statinfo.st_size
+                self.section_length = statinfo.st_size - file_offset
+                self.expanded_length = statinfo.st_size - file_offset
             except:
                 error("file", filename, " is invalid or missing")
 
@@ -161,7 +211,8 @@ class TftfSection:
         # Unpack a section header from a TFTF header buffer, and return
         # a flag indicating if the section was a section-end
 
-        section_hdr = unpack_from("<LLLL", section_buf, section_offset)
+        section_hdr = TFTF_SECTION_DESCRIPTOR.unpack_from(section_buf,
+                                                          section_offset)
         self.section_length = section_hdr[0]
         self.expanded_length = section_hdr[1]
         self.copy_offset = section_hdr[2]
@@ -172,11 +223,11 @@ class TftfSection:
         # Pack a section header into a TFTF header buffer at the specified
         # offset, returning the offset of the next section.
 
-        pack_into("<LLLL", buf, offset,
-                  self.section_length,
-                  self.expanded_length,
-                  self.copy_offset,
-                  self.section_type)
+        TFTF_SECTION_DESCRIPTOR.pack_into(buf, offset,
+                                          self.section_length,
+                                          self.expanded_length,
+                                          self.copy_offset,
+                                          self.section_type)
         return offset + TFTF_SECTION_HDR_LENGTH
 
     def update(self, copy_offset):
@@ -203,6 +254,16 @@ class TftfSection:
         else:
             return "?"
 
+    def get_record(self):
+        # Return the section header as a dictionary (see: Tftf.get_record)
+
+        return OrderedDict([
+            ("section_type", self.section_type),
+            ("section_name", self.section_name(self.section_type)),
+            ("section_length", self.section_length),
+            ("expanded_length", self.expanded_length),
+            ("copy_offset", self.copy_offset)])
+
     def display_table_header(self, indent):
         # Print the section table column names, returning the column
         # header for the section table (no indentation)
@@ -239,7 +300,7 @@ class TftfSection:
             # for the user
             key_hash = blob[TFTF_SIGNATURE_OFF_KEY_HASH:
                             TFTF_SIGNATURE_OFF_KEY_SIGNATURE]
-            sig_block = unpack_from("<LL64s", blob, 0)
+            sig_block = TFTF_SIGNATURE_SUMMARY.unpack_from(blob, 0)
             print("{0:s}  Length:    {1:08x}".format(indent, sig_block[0]))
             print("{0:s}  Sig. type: {1:d}".format(indent, sig_block[1]))
             print("{0:s}  Key name:".format(indent))
@@ -258,8 +319,13 @@ class TftfSection:
 
 class Tftf:
     """TFTF representation"""
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, use_mmap=False, streaming=False):
         # Private fields
+        #
+        # In streaming mode, tftf_buf only ever holds the header: the
+        # sections record where their data comes from, and the data is
+        # copied straight to the output file by write().
+        self.streaming = streaming
         self.tftf_buf = bytearray(TFTF_HDR_LENGTH)
         self.collisions = []
         self.collisions_found = False
@@ -283,7 +349,7 @@ class Tftf:
         if filename:
             # Load the TFTF buffer and parse it for the TFTF header and
             # section list
-            self.load_tftf_file(filename)
+            self.load_tftf_file(filename, use_mmap)
         else:
             # Salt the list with the end-of-table, because we will be
             # adding sections manually later
@@ -291,7 +357,8 @@ class Tftf:
                               0, 0, 0, None)
             self.sections.append(eot)
 
-    def load_tftf_file(self, filename):
+    @timed("tftf.load")
+    def load_tftf_file(self, filename, use_mmap=False):
         """Try to import a TFTF header and/or file
 
         If "buf" is None, then we only import the TFTF header.  However, if
@@ -299,6 +366,11 @@ class Tftf:
         entire TFTF file is also imported into the buffer.  This is to allow
         for cases where the caller needs to determine the TFTF characteristics
         before creating their buffer.
+
+        If use_mmap is set, the file is mapped read-only rather than read,
+        so that only the pages actually touched (typically just the header)
+        are brought in.  The buffer is copied into memory only if the TFTF
+        is subsequently modified.
         """
         success = True
         if filename:
@@ -311,7 +383,7 @@ class Tftf:
                     rf = open(name, 'rb')
                     break
                 except:
-                    print("can't find TFTF file"), filename
+                    error("can't find TFTF file", name)
                     success = False
 
             if success:
@@ -321,10 +393,16 @@ class Tftf:
                 self.tftf_length = rf.tell()
 
                 rf.seek(0, 0)
-                # (Display-tftf case) Read the entire TFTF file into
-                # a local buffer
-                self.tftf_buf = bytearray(self.tftf_length)
-                rf.readinto(self.tftf_buf)
+                if use_mmap and self.tftf_length >= TFTF_HDR_LENGTH:
+                    # (Inspection case) Map the TFTF file read-only
+                    self.tftf_buf = mmap.mmap(rf.fileno(), 0,
+                                              access=mmap.ACCESS_READ)
+                else:
+                    # (Display-tftf case) Read the entire TFTF file into
+                    # a local buffer
+                    self.tftf_buf = bytearray(self.tftf_length)
+                    rf.readinto(self.tftf_buf)
+                    count("bytes_read", self.tftf_length)
                 rf.close()
                 self.unpack()
         return success
@@ -332,11 +410,18 @@ class Tftf:
     def load_tftf_from_buffer(self, buf):
         """Import a TFTF blob from a memory buffer"""
         self.tftf_buf = buf
+        self.tftf_length = len(buf)
         self.unpack()
 
+    def make_writable(self):
+        # Ensure the TFTF buffer can be modified, copying a read-only
+        # (e.g., memory-mapped) buffer into memory if need be.
+        if not isinstance(self.tftf_buf, bytearray):
+            self.tftf_buf = bytearray(self.tftf_buf)
+
     def unpack(self):
         # Unpack a TFTF header from a buffer
-        tftf_hdr = unpack_from("<4s16s48sLLLLLLLL", self.tftf_buf)
+        tftf_hdr = TFTF_HEADER.unpack_from(self.tftf_buf)
         self.sentinel = tftf_hdr[0]
         self.timestamp = tftf_hdr[1]
         self.firmware_package_name = tftf_hdr[2]
@@ -353,24 +438,34 @@ class Tftf:
         # list from the file
         self.sections = []
 
-        # Parse the table of section headers
-        section_offset = TFTF_HDR_OFF_SECTIONS
-        for section_index in range(TFTF_MAX_SECTIONS):
-            section = TftfSection(0, 0, 0, 0, None)
-            if section.unpack(self.tftf_buf, section_offset):
-                self.sections.append(section)
-                section_offset += TFTF_SECTION_HDR_LENGTH
-
-                if section.section_type == \
-                   TFTF_SECTION_TYPE_END_OF_DESCRIPTORS:
+        # Parse the table of section headers (decoded in one go)
+        truncated = False
+        section_table = TFTF_SECTION_TABLE.iter_unpack(self.tftf_buf,
+                                                       TFTF_HDR_OFF_SECTIONS)
+        for section_index, section_hdr in enumerate(section_table):
+            section_length, expanded_length, copy_offset, section_type = \
+                section_hdr
+            if section_type in valid_tftf_types:
+                self.sections.append(TftfSection(section_type,
+                                                 section_length,
+                                                 expanded_length,
+                                                 copy_offset))
+
+                if section_type == TFTF_SECTION_TYPE_END_OF_DESCRIPTORS:
                     break
             else:
                 error("Invalid section type {0:02x} "
-                      "at [{1:d}]".format(section.section_type,
-                                          section_index))
+                      "at [{1:d}]".format(section_type, section_index))
                 break
+        else:
+            # (Without an end-of-table marker, the table must be full)
+            truncated = len(self.sections) < TFTF_MAX_SECTIONS
         self.sniff_test()
+        if truncated:
+            error("Truncated section table")
+            self.header_validity = TFTF_INVALID
 
+    @timed("tftf.pack")
     def pack(self):
         # Pack the TFTF header members into the TFTF header buffer, prior
         # to writing the buffer out to a file.
@@ -378,30 +473,36 @@ class Tftf:
         # Populate the fixed part of the TFTF header.
         # (Note that we need to break up the packing because the "s" format
         # doesn't zero-pad a string shorter than the field width)
-        pack_into("<4s16s", self.tftf_buf, 0,
-                  self.sentinel,
-                  self.timestamp)
+        self.make_writable()
+        TFTF_HEADER_ID.pack_into(self.tftf_buf, 0,
+                                 self.sentinel,
+                                 self.timestamp)
         if self.firmware_package_name:
-            pack_into("<48s", self.tftf_buf, TFTF_HDR_OFF_NAME,
-                      self.firmware_package_name)
-        pack_into("<LLLLLLLL", self.tftf_buf, TFTF_HDR_OFF_LENGTH,
-                  self.load_length,
-                  self.load_base,
-                  self.expanded_length,
-                  self.start_location,
-                  self.unipro_mfg_id,
-                  self.unipro_pid,
-                  self.ara_vid,
-                  self.ara_pid)
+            TFTF_HEADER_NAME.pack_into(self.tftf_buf, TFTF_HDR_OFF_NAME,
+                                       self.firmware_package_name)
+        TFTF_HEADER_FIELDS.pack_into(self.tftf_buf, TFTF_HDR_OFF_LENGTH,
+                                     self.load_length,
+                                     self.load_base,
+                                     self.expanded_length,
+                                     self.start_location,
+                                     self.unipro_mfg_id,
+                                     self.unipro_pid,
+                                     self.ara_vid,
+                                     self.ara_pid)
 
         # Pack the section headers into the TFTF header buffer
         offset = TFTF_HDR_OFF_SECTIONS
         for section in self.sections:
             offset = section.pack(self.tftf_buf, offset)
 
-    def add_section(self, section_type, section_data, copy_offset=0, skip=0):
+    def add_section(self, section_type, section_data, copy_offset=0, skip=0,
+                    expanded_length=None):
         # Add a new section to the section table and return a success flag
         #
+        # The expanded_length defaults to the length of the section data,
+        # and is otherwise that of the uncompressed data of a compressed
+        # section.
+        #
         # (This would be called by "sign-tftf" to add signature and
         # certificate blocks.)
 
@@ -410,41 +511,75 @@ class Tftf:
             # Insert the section to the section list, just in front of
             # the end-of-table marker.
             #
-            # Notes:
-            #   1. We assume this is an uncompressable section
-            #   2. We defer pushing the new section into the buffer until
-            #      the write stage or someone explicitly calls "pack".)
-            self.sections.insert(num_sections - 1,
-                                 TftfSection(section_type,
-                                             len(section_data) - skip,
-                                             len(section_data) - skip,
-                                             copy_offset, None))
-
-            # Append the section data blob to our TFTF buffer
-            self.tftf_buf += section_data[skip:]
-
-            # Record the length of the entire TFTF blob (this will be longer
-            # than the header's load_length)
-            self.tftf_length = len(self.tftf_buf)
+            # (We defer pushing the new section into the buffer until
+            # the write stage or someone explicitly calls "pack".)
+            if expanded_length is None:
+                expanded_length = len(section_data) - skip
+            section = TftfSection(section_type,
+                                  len(section_data) - skip,
+                                  expanded_length,
+                                  copy_offset, None)
+            self.sections.insert(num_sections - 1, section)
+
+            if self.streaming:
+                # Hang on to the blob until the write stage
+                section.blob = section_data[skip:]
+                self.tftf_length = self.get_streamed_length()
+            else:
+                # Append the section data blob to our TFTF buffer
+                self.make_writable()
+                self.tftf_buf += section_data[skip:]
+
+                # Record the length of the entire TFTF blob (this will be
+                # longer than the header's load_length)
+                self.tftf_length = len(self.tftf_buf)
             return True
         else:
             error("Section table full")
             return False
 
     def add_section_from_file(self, section_type, filename, copy_offset=0, \
-                              skip=0):
+                              skip=0, length=None, expanded_length=None):
         # Add a new section from a file and return a success flag
         #
+        # The section is the rest of the file after the first skip bytes,
+        # or only the next length bytes if a length is given (e.g., an ELF
+        # segment).  The expanded_length defaults to the section length,
+        # and is otherwise the length to which the loader zero-fills the
+        # section (e.g., a segment ending in ".bss").
+        #
         # (This would be called by "create-tftf" while/after parsing section
         # parameters)
 
         if len(self.sections) < TFTF_MAX_SECTIONS:
+            if self.streaming:
+                # Only record the section descriptor; the data is copied
+                # from the file at the write stage.
+                if not os.access(filename, os.R_OK):
+                    error("Unable to read", filename)
+                    return False
+                section = TftfSection(section_type, 0, 0, copy_offset,
+                                      filename, skip)
+                if length is not None:
+                    section.section_length = length
+                section.expanded_length = section.section_length
+                if expanded_length is not None:
+                    section.expanded_length = expanded_length
+                self.sections.insert(len(self.sections) - 1, section)
+                self.tftf_length = self.get_streamed_length()
+                return True
+
             try:
                 with open(filename, 'rb') as readfile:
-                    section_data = readfile.read()
+                    readfile.seek(skip)
+                    if length is None:
+                        section_data = readfile.read()
+                    else:
+                        section_data = readfile.read(length)
+                count("bytes_read", len(section_data))
 
                 return self.add_section(section_type, section_data,
-                                        copy_offset, skip)
+                                        copy_offset, 0, expanded_length)
             except:
                 error("Unable to read", filename)
                 return False
@@ -452,6 +587,41 @@ class Tftf:
             error("Section table full")
             return False
 
+    def add_compressed_section_from_file(self, section_type, filename,
+                                         copy_offset=0, skip=0,
+                                         level=TFTF_COMPRESSION_LEVEL,
+                                         compressed=None):
+        # Add a new compressed section from a file and return a success flag
+        #
+        # The file is compressed a chunk at a time (see: compress_file),
+        # unless the result of compressing it is supplied as compressed.
+        # If that doesn't make it any smaller, the section is added
+        # uncompressed instead, as the corresponding raw section type.
+        if compressed:
+            section_data, expanded_length = compressed
+        else:
+            try:
+                section_data, expanded_length = compress_file(filename, skip,
+                                                              level)
+            except (IOError, OSError):
+                error("Unable to read", filename)
+                return False
+
+        if len(section_data) >= expanded_length:
+            return self.add_section_from_file(
+                uncompressed_tftf_types[section_type], filename,
+                copy_offset, skip)
+        return self.add_section(section_type, section_data, copy_offset, 0,
+                                expanded_length)
+
+    def get_streamed_length(self):
+        # Return the length of the entire TFTF blob that a streaming TFTF
+        # will write: the header followed by all of the section data.
+        length = TFTF_HDR_LENGTH
+        for section in self.sections:
+            length += section.section_length
+        return length
+
     def update_section_table_offsets(self):
         # Update the copy_offsets in the section table and the load_length
         #
@@ -485,32 +655,16 @@ class Tftf:
         # This would be called by "create-ffff" after parsing all of the
         # parameters and calling update_ffff_sections().
 
-        for comp_a, section_a in enumerate(self.sections):
-            collision = []
-            # extract sections[comp_a]
-            if section_a.section_type == TFTF_SECTION_TYPE_SIGNATURE or \
-               section_a.section_type == TFTF_SECTION_TYPE_END_OF_DESCRIPTORS:
+        # Only the sections up to the first signature are checked
+        extents = []
+        for section in self.sections:
+            if section.section_type == TFTF_SECTION_TYPE_SIGNATURE or \
+               section.section_type == TFTF_SECTION_TYPE_END_OF_DESCRIPTORS:
                 break
+            extents.append((section.copy_offset, section.expanded_length))
 
-            start_a = section_a.copy_offset
-            end_a = start_a + section_a.expanded_length - 1
-            for comp_b, section_b in enumerate(self.sections):
-                # skip checking one's self
-                if comp_a != comp_b:
-                    # extract sections[comp_b]
-                    if section_b.section_type == \
-                       TFTF_SECTION_TYPE_SIGNATURE or \
-                       section_b.section_type == \
-                       TFTF_SECTION_TYPE_END_OF_DESCRIPTORS:
-                        break
-
-                    start_b = section_b.copy_offset
-                    end_b = start_b + section_b.expanded_length - 1
-                    if end_b >= start_a and \
-                       start_b <= end_a:
-                        self.collisions_found = True
-                        collision += [comp_b]
-            self.collisions += [collision]
+        self.collisions = find_overlaps(extents)
+        self.collisions_found = any(self.collisions)
         return self.collisions_found
 
     def sniff_test(self):
@@ -534,6 +688,7 @@ class Tftf:
 
         return self.header_validity != TFTF_INVALID
 
+    @timed("tftf.post_process")
     def post_process(self):
         """Post-process the TFTF header
 
@@ -542,12 +697,12 @@ class Tftf:
         """
         self.sentinel == TFTF_SENTINEL
 
-        # Update the section table copy_offsets and check for collisions
+        # Update the section table copy_offsets (collisions are checked
+        # by the sniff test below)
         self.sentinel = TFTF_SENTINEL
         self.update_section_table_offsets()
-        self.check_for_collisions()
         if self.timestamp == "":
-            self.timestamp = strftime("%Y%m%d %H%M%S", gmtime())
+            self.timestamp = get_timestamp()
 
         # Trim the name to length
         if self.firmware_package_name:
@@ -557,11 +712,14 @@ class Tftf:
         # Determine the validity
         self.sniff_test()
 
-    def write(self, out_filename):
+    @timed("tftf.write")
+    def write(self, out_filename, atomic=False):
         """Create the TFTF file and return a success flag
 
         Create the TFTF file (appending the default extension if omitted)
-        and write the TFTF buffer to it.
+        and write the TFTF buffer to it.  If atomic is set, the TFTF is
+        written to a temporary file which then replaces the output file,
+        so that the output file is never seen partially written.
         """
         success = True
         # Prepare the output buffer
@@ -569,28 +727,46 @@ class Tftf:
 
         # Record the length of the entire TFTF blob (this will be longer
         # than the header's load_length)
-        self.tftf_length = len(self.tftf_buf)
+        if self.streaming:
+            self.tftf_length = self.get_streamed_length()
+        else:
+            self.tftf_length = len(self.tftf_buf)
 
         # Ensure the output file ends in the default TFTF file extension if
         # the user hasn't specified their own extension.
         if rfind(out_filename, ".") == -1:
             out_filename += TFTF_FILE_EXTENSION
 
+        write_filename = out_filename
         try:
-            with open(out_filename, 'wb') as wf:
+            if atomic:
+                wf, write_filename = create_temp_file(out_filename)
+            else:
+                wf = open(out_filename, 'wb')
+            with wf:
                 # Write the TFTF header
                 wf.write(self.tftf_buf)
 
+                # (Streaming case) Copy in the section data
+                if self.streaming:
+                    self.write_section_data(wf)
+            count("bytes_written", self.tftf_length)
+
             # verify the file is the correct length
             try:
-                statinfo = os.stat(out_filename)
+                statinfo = os.stat(write_filename)
                 if statinfo.st_size != self.tftf_length:
                     error(out_filename, "has wrong length")
             except:
                 error("Can't get info on", out_filename)
 
+            if atomic:
+                replace_file(write_filename, out_filename)
         except:
             error("Unable to write", out_filename)
+            if write_filename != out_filename and \
+               os.path.exists(write_filename):
+                os.remove(write_filename)
             success = False
         else:
             if success:
@@ -599,6 +775,61 @@ class Tftf:
                 error("Failed to write", out_filename)
             return success
 
+    def write_section_data(self, wf):
+        # Copy the section data for a streaming TFTF out to a file
+        #
+        # Sections are copied in table order, reading file-based sections
+        # through a single buffer of at most copy_blob_size bytes.
+        copy_buf = None
+        for section in self.sections:
+            if section.section_type == TFTF_SECTION_TYPE_END_OF_DESCRIPTORS:
+                break
+            if section.blob is not None:
+                wf.write(section.blob)
+            elif section.filename:
+                if not copy_buf:
+                    copy_buf = memoryview(bytearray(
+                        min(copy_blob_size,
+                            max(s.section_length for s in self.sections))))
+                with open(section.filename, 'rb') as rf:
+                    rf.seek(section.file_offset)
+                    remaining = section.section_length
+                    while remaining > 0:
+                        length = rf.readinto(
+                            copy_buf[0:min(remaining, len(copy_buf))])
+                        if not length:
+                            raise IOError("{0:s} is truncated".format(
+                                          section.filename))
+                        wf.write(copy_buf[0:length])
+                        remaining -= length
+                count("bytes_read", section.section_length)
+
+    def get_record(self):
+        """Return the TFTF header as a dictionary
+
+        This is the machine-readable counterpart of display(), holding the
+        header fields, the section table, any section collisions (a list
+        of the colliding section indices for each section) and the
+        header's validity.
+        """
+        return OrderedDict([
+            ("tftf_length", self.tftf_length),
+            ("validity", tftf_validity_names[self.header_validity]),
+            ("sentinel", c_string(self.sentinel)),
+            ("timestamp", c_string(self.timestamp)),
+            ("firmware_package_name", c_string(self.firmware_package_name)),
+            ("load_length", self.load_length),
+            ("load_base", self.load_base),
+            ("expanded_length", self.expanded_length),
+            ("start_location", self.start_location),
+            ("unipro_mfg_id", self.unipro_mfg_id),
+            ("unipro_pid", self.unipro_pid),
+            ("ara_vid", self.ara_vid),
+            ("ara_pid", self.ara_pid),
+            ("sections", [section.get_record()
+                          for section in self.sections]),
+            ("collisions", self.collisions)])
+
     def display(self, title=None, indent=""):
         """Display a single TFTF header"""
         # 1. Dump the contents of the fixed part of the TFTF header
@@ -667,15 +898,153 @@ class Tftf:
         print(title_string)
 
         # 2. Print the associated data blobs
-        offset = TFTF_HDR_LENGTH
         for index, section in enumerate(self.sections):
             if section.section_type == TFTF_SECTION_TYPE_END_OF_DESCRIPTORS:
                 break
-            end = offset + section.section_length - 1
-            section.display_data(self.tftf_buf[offset:end],
+            section.display_data(self.get_section_data(index),
                                  "section [{0:d}] ".format(index),
                                  indent + "  ")
+
+    def get_section_data(self, section_index):
+        """Return the payload for section_table[index]
+
+        Returns a zero-copy view onto the section's data in the TFTF
+        buffer, or None if the index is out of range.  (With a memory-mapped
+        TFTF, only the pages covered by the section are read when the view
+        is accessed.)
+
+        For a streaming TFTF, the data is fetched from wherever the section
+        was added from.
+        """
+        if section_index >= len(self.sections):
+            return None
+
+        if self.streaming:
+            section = self.sections[section_index]
+            if section.blob is not None:
+                return buffer_view(section.blob)
+            elif section.filename:
+                with open(section.filename, 'rb') as rf:
+                    rf.seek(section.file_offset)
+                    return rf.read(section.section_length)
+            return bytearray(0)
+
+        offset = TFTF_HDR_LENGTH
+        for section in self.sections[0:section_index]:
             offset += section.section_length
+        return buffer_view(self.tftf_buf, offset,
+                           self.sections[section_index].section_length)
+
+    def iter_section_data(self, section_index):
+        """Return the payload for section_table[index] as a chunk sequence
+
+        Like get_section_data, but yields the data in chunks of at most
+        copy_blob_size bytes, so that streamed sections are never read into
+        memory whole.
+        """
+        section = self.sections[section_index]
+        if self.streaming and section.blob is None and section.filename:
+            with open(section.filename, 'rb') as rf:
+                rf.seek(section.file_offset)
+                remaining = section.section_length
+                while remaining > 0:
+                    chunk = rf.read(min(remaining, copy_blob_size))
+                    if not chunk:
+                        raise IOError("{0:s} is truncated".format(
+                                      section.filename))
+                    remaining -= len(chunk)
+                    yield chunk
+        else:
+            data = self.get_section_data(section_index)
+            for offset in range(0, len(data), copy_blob_size):
+                yield data[offset:offset + copy_blob_size]
+
+    def get_signable_chunks(self, section_index=None):
+        """Return the blob to be signed as a sequence of chunks
+
+        The signable blob consists of the first part of the TFTF header,
+        up to section_table[index], followed by the data of the preceding
+        sections.  The index defaults to that of the first signature
+        section.  The chunks are views onto the TFTF buffer wherever
+        possible, so hashing them (see: util.update_digest) needs no
+        copy of the TFTF.  (A memory-mapped TFTF is used as mapped.)
+
+        (Used to sign and verify a TFTF.)
+        """
+        if section_index is None:
+            section_index = \
+                self.find_first_section(TFTF_SECTION_TYPE_SIGNATURE)
+
+        # Flush any changes out to the (writable) buffer
+        if isinstance(self.tftf_buf, bytearray):
+            self.pack()
+        yield buffer_view(self.tftf_buf, 0,
+                          TFTF_HDR_OFF_SECTIONS +
+                          section_index * TFTF_SECTION_HDR_LENGTH)
+        for index in range(min(section_index, len(self.sections))):
+            for chunk in self.iter_section_data(index):
+                yield chunk
+
+    @timed("tftf.verify")
+    def verify(self, public_keys):
+        """Verify the TFTF signatures and return a success flag
+
+        public_keys maps key names onto public keys (e.g., M2Crypto RSA
+        public keys), each providing verify(digest, signature, hash).
+        Every signature section is checked, using the key named in its
+        signature block, against the signable blob as defined by
+        "sign-tftf": the header and data up to the first signature section.
+        The TFTF verifies only if it is signed and all of its signatures
+        are good.
+        """
+        first_signature = \
+            self.find_first_section(TFTF_SECTION_TYPE_SIGNATURE)
+        digests = {}
+        num_signatures = 0
+        success = True
+        for index, section in enumerate(self.sections):
+            if section.section_type != TFTF_SECTION_TYPE_SIGNATURE:
+                continue
+            num_signatures += 1
+
+            signature_block = \
+                SignatureBlock(bytearray(self.get_section_data(index)))
+            key_name = signature_block.key_name.rstrip("\0")
+            hash_algorithm = \
+                get_hash_from_signature_type(signature_block.signature_type)
+            if not hash_algorithm:
+                error("Section [{0:d}] has an unknown signature type".format(
+                      index))
+                success = False
+                continue
+            if key_name not in public_keys:
+                error("Section [{0:d}] is signed with unknown key '{1:s}'".
+                      format(index, key_name))
+                success = False
+                continue
+
+            # All the signatures cover the same blob, so it only needs
+            # hashing once per hash algorithm
+            if hash_algorithm not in digests:
+                digests[hash_algorithm] = update_digest(
+                    hashlib.new(hash_algorithm),
+                    self.get_signable_chunks(first_signature)).digest()
+            try:
+                good = public_keys[key_name].verify(
+                    digests[hash_algorithm],
+                    str(signature_block.signature),
+                    hash_algorithm)
+            except:
+                good = False
+            if not good:
+                error("Section [{0:d}] has a bad signature from '{1:s}'".
+                      format(index, key_name))
+                success = False
+
+        if num_signatures == 0:
+            error("No signatures found")
+            success = False
+        return success
 
     def find_first_section(self, section_type):
         """Find the index of the first section of the specified type
@@ -726,6 +1095,6 @@ class Tftf:
         # Flush any changes out to the buffer and return the substring
         self.pack()
         slice_end = TFTF_HDR_LENGTH
-        for index, section in enumerate(self.sections):
+        for section in self.sections[0:section_index]:
             slice_end += section.section_length
         return self.tftf_buf[TFTF_HDR_LENGTH:slice_end]
@@ -30,7 +30,23 @@
 
 from __future__ import print_function
 import sys
+import os
+import errno
 import binascii
+import csv
+import json
+import shutil
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from stat import S_IMODE
+from tempfile import mkstemp
+from heapq import heappush, heappop
+from time import gmtime, strftime, strptime
+from profiling import profile_workers, merge_worker_results
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Program return values
 PROGRAM_SUCCESS = 0
@@ -62,9 +78,413 @@ def next_boundary(location, block_size):
     return (location + (block_size - 1)) & ~(block_size - 1)
 
 
+def find_overlaps(extents):
+    """Find the overlaps within a list of extents
+
+    extents is a list of (start, length) tuples.  Returns a list holding,
+    for each extent, the ascending indices of the other extents which
+    overlap it.
+
+    The extents are swept in order of their start locations, keeping a
+    heap of the ones still open, so this runs in O(n log n) time (plus
+    the number of overlaps found) rather than comparing every pair.
+    """
+    overlaps = [[] for extent in extents]
+    open_extents = []
+    for index in sorted(range(len(extents)), key=lambda i: extents[i][0]):
+        start = extents[index][0]
+        end = start + extents[index][1] - 1
+
+        # Retire the extents which end before this one starts
+        while open_extents and open_extents[0][0] < start:
+            heappop(open_extents)
+
+        for open_end, open_index in open_extents:
+            if extents[open_index][0] <= end:
+                overlaps[index].append(open_index)
+                overlaps[open_index].append(index)
+        heappush(open_extents, (end, index))
+
+    for overlap in overlaps:
+        overlap.sort()
+    return overlaps
+
+
+def find_duplicates(keys):
+    """Find the duplicates within a list of keys
+
+    Returns a list holding, for each key, the ascending indices of the
+    other entries having the same key.
+    """
+    groups = {}
+    for index, key in enumerate(keys):
+        groups.setdefault(key, []).append(index)
+    return [[other for other in groups[key] if other != index]
+            for index, key in enumerate(keys)]
+
+
+# Size of the chunks in which fill detection is done
+FILL_CHUNK_SIZE = 64 * 1024
+
+# Fill patterns (see: fill_pattern), indexed by fill byte
+fill_patterns = {}
+
+
+def fill_pattern(fill_byte):
+    """Return a FILL_CHUNK_SIZE run of a fill byte, for comparisons"""
+    if fill_byte not in fill_patterns:
+        fill_patterns[fill_byte] = chr(fill_byte) * FILL_CHUNK_SIZE
+    return fill_patterns[fill_byte]
+
+
+def find_non_fill(buf, fill_byte, offset=0, length=None):
+    """Find the first byte in a range that isn't the fill byte
+
+    The range is compared against a fill pattern a chunk at a time, so
+    the scan runs at memcmp speed.  Returns the offset of the first
+    non-fill byte (relative to the start of buf), or -1 if the range is
+    entirely fill.  buf may be a str, bytearray, mmap or memoryview.
+    """
+    pattern = fill_pattern(fill_byte)
+    if length is None:
+        length = len(buf) - offset
+    end = offset + length
+    while offset < end:
+        chunk_size = min(end - offset, FILL_CHUNK_SIZE)
+        chunk = buf[offset:offset + chunk_size]
+        if isinstance(chunk, memoryview):
+            # (memoryviews have no lstrip)
+            chunk = chunk.tobytes()
+        if chunk != pattern[0:chunk_size]:
+            # Pinpoint the first non-fill byte in this chunk
+            return offset + chunk_size - len(chunk.lstrip(pattern[0]))
+        offset += chunk_size
+    return -1
+
+
 def is_constant_fill(bytes, fill_byte):
     """Check a range of bytes for a constant fill"""
-    return all(b == fill_byte for b in bytes)
+    return find_non_fill(bytes, fill_byte) < 0
+
+
+def get_blank_block_map(buf, block_size, fill_byte=0xff):
+    """Map out the blank (erased) blocks in a flash image
+
+    Returns a list with a flag for each block_size block of the buffer
+    (the last of which may be partial), set if the block consists
+    entirely of the fill byte.
+    """
+    blank_blocks = []
+    for offset in range(0, len(buf), block_size):
+        length = min(block_size, len(buf) - offset)
+        blank_blocks.append(find_non_fill(buf, fill_byte, offset,
+                                          length) < 0)
+    return blank_blocks
+
+
+def buffer_view(buf, offset=0, length=None):
+    """Return a zero-copy view onto part of a buffer
+
+    Returns a memoryview slice where the buffer supports one, falling
+    back to a buffer object for those (such as mmaps) that don't.
+    """
+    if length is None:
+        length = len(buf) - offset
+    try:
+        return memoryview(buf)[offset:offset + length]
+    except TypeError:
+        return buffer(buf, offset, length)
+
+
+# Size of the chunks in which fills and sparse copies are done
+SPARSE_CHUNK_SIZE = 64 * 1024
+
+
+def write_fill(wf, length, fill_byte=0, overwrite=False):
+    """Fill the next length bytes of a file
+
+    A zero fill is simply seeked over, leaving a hole in a sparse file
+    (the file must later be written or truncated beyond the hole), unless
+    overwrite is set (i.e., the fill replaces existing data).  Any other
+    fill byte is written out a chunk at a time.
+    """
+    if fill_byte == 0 and not overwrite:
+        wf.seek(length, os.SEEK_CUR)
+    else:
+        fill = chr(fill_byte) * min(length, SPARSE_CHUNK_SIZE)
+        while length > 0:
+            wf.write(fill[0:min(length, len(fill))])
+            length -= len(fill)
+
+
+def copy_sparse(rf, wf):
+    """Copy the remainder of one file to another, keeping it sparse
+
+    All-zero chunks are seeked over rather than written.  Returns the
+    number of bytes copied.
+    """
+    length = 0
+    while True:
+        chunk = rf.read(SPARSE_CHUNK_SIZE)
+        if not chunk:
+            break
+        if chunk.count("\0") == len(chunk):
+            wf.seek(len(chunk), os.SEEK_CUR)
+        else:
+            wf.write(chunk)
+        length += len(chunk)
+
+    # Extend the file over any trailing hole
+    wf.truncate(wf.tell())
+    return length
+
+
+def read_chunks(rf, chunk_size=SPARSE_CHUNK_SIZE):
+    """Yield the rest of a file a chunk at a time"""
+    while True:
+        chunk = rf.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def update_digest(digest, chunks):
+    """Feed a sequence of chunks into a message digest
+
+    The digest is updated a chunk at a time (e.g., with the views from
+    Tftf.get_signable_chunks), so the data need never be assembled into
+    a single blob.  Returns the digest.
+    """
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest
+
+
+def create_temp_file(filename):
+    """Create a temporary file alongside a file
+
+    Returns an open (binary) file object and the name of the temporary
+    file.  Once written, the temporary file can atomically replace the
+    original with replace_file().
+    """
+    fd, temp_filename = mkstemp(prefix=os.path.basename(filename) + ".",
+                                dir=os.path.dirname(filename) or ".")
+    return os.fdopen(fd, 'wb'), temp_filename
+
+
+def replace_file(temp_filename, filename):
+    """Atomically replace a file with a temporary file
+
+    The replacement keeps the permissions of the original file (or, if
+    there isn't one, those a newly-created file would have).
+    """
+    try:
+        mode = S_IMODE(os.stat(filename).st_mode)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    os.chmod(temp_filename, mode)
+    os.rename(temp_filename, filename)
+
+
+# ioctl request to make a copy-on-write clone of a file (Linux FICLONE)
+FICLONE = 0x40049409
+
+
+def clone_file(src_filename, filename, allow_link=True):
+    """Atomically replace a file with a clone of another
+
+    The clone is a reflink (a copy-on-write copy) where the filesystem
+    supports it, otherwise a hard link (if allow_link) and otherwise a
+    plain copy.  Note that a hard-linked file must only be replaced, not
+    written in place, or the source changes with it.  Returns how the
+    clone was made: "reflink", "link" or "copy".
+    """
+    wf, temp_filename = create_temp_file(filename)
+    try:
+        with wf:
+            method = "copy"
+            with open(src_filename, 'rb') as rf:
+                try:
+                    if fcntl:
+                        fcntl.ioctl(wf.fileno(), FICLONE, rf.fileno())
+                        method = "reflink"
+                except (IOError, OSError):
+                    pass
+        if method == "copy" and allow_link:
+            try:
+                os.remove(temp_filename)
+                os.link(src_filename, temp_filename)
+                method = "link"
+            except OSError:
+                pass
+        if method == "copy":
+            with open(src_filename, 'rb') as rf, \
+                 open(temp_filename, 'wb') as wf:
+                shutil.copyfileobj(rf, wf, SPARSE_CHUNK_SIZE)
+
+        if method == "link":
+            # (The permissions are shared with the source)
+            os.rename(temp_filename, filename)
+        else:
+            replace_file(temp_filename, filename)
+    except:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+    return method
+
+
+def evict_lru_files(directory, extension, max_size):
+    """Trim a cache directory to size
+
+    Removes the least-recently-used (i.e., oldest mtime) files with the
+    given extension from the directory until their total size is no more
+    than max_size bytes.
+    """
+    entries = []
+    cache_size = 0
+    for name in os.listdir(directory):
+        if not name.endswith(extension):
+            continue
+        filename = os.path.join(directory, name)
+        try:
+            statinfo = os.stat(filename)
+        except OSError:
+            # Evicted by someone else
+            continue
+        entries.append((statinfo.st_mtime, statinfo.st_size, filename))
+        cache_size += statinfo.st_size
+
+    entries.sort()
+    for mtime, size, filename in entries:
+        if cache_size <= max_size:
+            break
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        cache_size -= size
+
+
+# Format of the TFTF and FFFF header timestamps
+TIMESTAMP_FORMAT = "%Y%m%d %H%M%S"
+
+
+def get_source_date_epoch():
+    """Return the SOURCE_DATE_EPOCH environment variable, if set
+
+    SOURCE_DATE_EPOCH (seconds since the epoch) pins the timestamps of a
+    reproducible build.  Returns None if it is unset or empty, and exits
+    with EINVAL if it isn't a valid number of seconds.
+    """
+    epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    if not epoch:
+        return None
+    if not epoch.isdigit():
+        error("SOURCE_DATE_EPOCH must be seconds since the epoch, not",
+              repr(epoch))
+        sys.exit(errno.EINVAL)
+    return int(epoch)
+
+
+def get_timestamp(timestamp=None):
+    """Return a timestamp for a TFTF or FFFF header
+
+    The timestamp is either seconds since the epoch or a string already in
+    header form ("YYYYMMDD HHMMSS").  If it is None, the timestamp is taken
+    from the SOURCE_DATE_EPOCH environment variable if set (for
+    reproducible builds), otherwise from the current time.
+    """
+    if timestamp is None:
+        timestamp = get_source_date_epoch()
+    if isinstance(timestamp, basestring):
+        return timestamp
+    return strftime(TIMESTAMP_FORMAT, gmtime(timestamp))
+
+
+def timestamp_arg(x):
+    # argparse type for a --timestamp: seconds since the epoch or a
+    # header-form "YYYYMMDD HHMMSS" string
+    if x.isdigit():
+        return int(x)
+    strptime(x, TIMESTAMP_FORMAT)
+    return x
+
+
+def add_timestamp_argument(parser, help="The timestamp for the header(s)"):
+    """Add the --timestamp option to an argparse parser"""
+    parser.add_argument("--timestamp",
+                        type=timestamp_arg,
+                        help=help + " (seconds since the epoch or "
+                             "\"YYYYMMDD HHMMSS\", default: "
+                             "$SOURCE_DATE_EPOCH or now)")
+
+
+def c_string(s):
+    """Return the contents of a NUL-padded string field"""
+    if not s:
+        return ""
+    return s.split("\0", 1)[0]
+
+
+def map_in_order(function, items, num_processes=1, threads=False,
+                 initializer=None, initargs=()):
+    """Apply a function to each item, yielding the results in order
+
+    If num_processes is more than 1, the items are spread across a pool
+    of worker processes, and so the function and its results must be
+    picklable.  If threads is set, the pool is of threads instead (which
+    suits work such as file I/O, hashing and compression, during which
+    the GIL is released).  If there is an initializer, it is called with
+    initargs in each worker as it starts or, without a pool, once here.
+    """
+    if num_processes > 1 and len(items) > 1:
+        if threads:
+            pool = ThreadPool(min(num_processes, len(items)), initializer,
+                              initargs)
+            results = pool.imap(function, items)
+        else:
+            # (The workers' profiles are merged into this one's)
+            pool = Pool(min(num_processes, len(items)), initializer,
+                        initargs)
+            worker_function = profile_workers(function)
+            results = pool.imap(worker_function, items)
+            if worker_function is not function:
+                results = merge_worker_results(results)
+        pool.close()
+        return results
+    else:
+        if initializer:
+            initializer(*initargs)
+        return (function(item) for item in items)
+
+
+def write_records(records, record_format, wf=sys.stdout):
+    """Write out a sequence of records in machine-readable form
+
+    Each record (typically an OrderedDict) is written as it arrives: as a
+    line of JSON for the "json" format, or as a row for the "csv" format.
+    The CSV columns are those of the first record, and any nested (list
+    or dictionary) fields are written in JSON form.
+    """
+    writer = None
+    for record in records:
+        if record_format == "csv":
+            if not writer:
+                writer = csv.DictWriter(wf, list(record.keys()),
+                                        restval="", extrasaction="ignore")
+                writer.writeheader()
+            row = {}
+            for key, value in record.items():
+                if isinstance(value, (list, dict)):
+                    value = json.dumps(value, encoding="latin-1")
+                row[key] = value
+            writer.writerow(row)
+        else:
+            wf.write(json.dumps(record, encoding="latin-1") + "\n")
+        wf.flush()
 
 
 def display_binary_data(blob, show_all, indent=""):